@@ -0,0 +1,190 @@
+from typing import Union  # Объединение типов
+from datetime import datetime, timedelta
+from collections import deque  # Очередь новых бар
+from threading import Condition  # Условие прихода нового бара и освобождения места в очереди
+from time import perf_counter  # Время постановки бара в очередь
+from array import array  # Колонки бар
+
+
+class Bar:
+    """Бар. Дата и время открытия в кол-ве секунд, прошедших с 01.01.1970 00:00, без учета временнОй зоны. Цены Алор, объем в лотах
+    Значения хранятся в слотах без словаря атрибутов. Бар занимает в памяти в несколько раз меньше словаря с datetime
+    """
+    __slots__ = ('seconds', 'open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, seconds, open, high, low, close, volume):
+        self.seconds = seconds  # Дата и время открытия бара в секундах
+        self.open = open  # Цена открытия
+        self.high = high  # Максимальная цена
+        self.low = low  # Минимальная цена
+        self.close = close  # Цена закрытия
+        self.volume = volume  # Объем в лотах
+
+    @property
+    def datetime(self) -> datetime:
+        """Дата и время открытия бара без временнОй зоны. Создается при каждом обращении"""
+        return datetime(1970, 1, 1) + timedelta(seconds=self.seconds)
+
+    def __repr__(self):
+        return f'Bar({self.datetime:%d.%m.%Y %H:%M:%S}, {self.open}, {self.high}, {self.low}, {self.close}, {self.volume})'
+
+
+class Bars:
+    """Бары в колонках. Каждая колонка - массив чисел, поэтому бар занимает в памяти 48 байт и не отслеживается сборщиком мусора
+    Бары выдаются с начала (popleft) без сдвига колонок. Объекты Bar создаются только при выдаче
+    """
+    columns = (('seconds', 'q'), ('open', 'd'), ('high', 'd'), ('low', 'd'), ('close', 'd'), ('volume', 'q'))  # Колонки и их типы. Совпадают со слотами бара
+
+    def __init__(self, bars=()):
+        self.seconds, self.opens, self.highs, self.lows, self.closes, self.volumes = (array(typecode) for _, typecode in self.columns)  # Колонки
+        self.start = 0  # Номер первого не выданного бара
+        self.extend(bars)
+
+    def append(self, bar) -> None:
+        """Добавление бара в конец"""
+        self.append_values(bar.seconds, bar.open, bar.high, bar.low, bar.close, bar.volume)
+
+    def append_values(self, seconds, open, high, low, close, volume) -> None:
+        """Добавление бара в конец по значениям без создания бара"""
+        self.seconds.append(seconds)
+        self.opens.append(open)
+        self.highs.append(high)
+        self.lows.append(low)
+        self.closes.append(close)
+        self.volumes.append(int(volume))
+
+    def extend(self, bars) -> None:
+        """Добавление бар в конец. Колонки бар добавляются целиком"""
+        if isinstance(bars, Bars):  # Если добавляем колонки бар
+            self.extend_columns(*bars.get_columns())  # то бары не создаем
+            return  # Дальше не продолжаем
+        for bar in bars:  # Пробегаемся по всем барам
+            self.append(bar)
+
+    def extend_columns(self, seconds, opens, highs, lows, closes, volumes) -> None:
+        """Добавление колонок в конец. Массивы и отображения в память с тем же типом значений копируются целиком"""
+        for column, values in zip((self.seconds, self.opens, self.highs, self.lows, self.closes, self.volumes), (seconds, opens, highs, lows, closes, volumes)):  # Пробегаемся по всем колонкам
+            if isinstance(values, memoryview) and values.format == column.typecode:  # Если значения отображены в память с тем же типом
+                column.frombytes(values.cast('B'))  # то копируем их одной операцией
+            else:  # Массив с тем же типом значений копируется целиком, остальные значения добавляются по одному
+                column.extend(values)
+
+    def popleft(self) -> Bar:
+        """Выдача первого бара с удалением"""
+        if self.start >= len(self.seconds):  # Если все бары выданы
+            raise IndexError('pop from an empty Bars')
+        bar = self.get_bar(self.start)  # Первый не выданный бар
+        self.start += 1  # Следующий бар
+        if self.start == len(self.seconds):  # Если выдали последний бар
+            self.clear()  # то освобождаем память колонок
+        return bar
+
+    def clear(self) -> None:
+        """Удаление всех бар"""
+        self.seconds, self.opens, self.highs, self.lows, self.closes, self.volumes = (array(typecode) for _, typecode in self.columns)
+        self.start = 0
+
+    def get_columns(self) -> tuple:
+        """Колонки не выданных бар: дата и время открытия в секундах, цены открытия, максимальные, минимальные, закрытия, объемы"""
+        return tuple(column[self.start:] for column in (self.seconds, self.opens, self.highs, self.lows, self.closes, self.volumes))
+
+    def get_bar(self, i) -> Bar:
+        """Бар по номеру в колонках"""
+        return Bar(self.seconds[i], self.opens[i], self.highs[i], self.lows[i], self.closes[i], self.volumes[i])
+
+    def __len__(self):
+        return len(self.seconds) - self.start  # Кол-во не выданных бар
+
+    def __getitem__(self, i) -> Bar:
+        if i < 0:  # Если номер с конца
+            i += len(self)  # то переводим его в номер с начала
+        if not 0 <= i < len(self):  # Если бара с таким номером нет
+            raise IndexError('Bars index out of range')
+        return self.get_bar(self.start + i)
+
+    def __iter__(self):
+        for i in range(self.start, len(self.seconds)):  # Пробегаемся по всем не выданным барам
+            yield self.get_bar(i)
+
+
+class BarQueue:
+    """Ограниченная очередь новых бар одной подписки/расписания. Потокобезопасна
+    Если очередь заполнена, то в зависимости от политики:
+    - block - поток, ставящий бар, ждет, пока данные не заберут бар, но не дольше block_sec. Затем удаляется самый старый бар
+    - drop_oldest - удаляется самый старый бар
+    - coalesce - как drop_oldest, но бар с той же датой и временем открытия, что и последний бар в очереди, заменяет его при любом заполнении очереди
+    """
+    policies = ('block', 'drop_oldest', 'coalesce')  # Политики переполнения очереди
+
+    def __init__(self, maxlen=0, policy='coalesce', block_sec=1):
+        """Инициализация
+
+        :param int maxlen: Максимальное кол-во бар в очереди. 0 - без ограничения
+        :param str policy: Политика переполнения очереди из policies
+        :param float block_sec: Максимальное время ожидания места в очереди в секундах для политики block
+        """
+        if policy not in self.policies:  # Если политика не поддерживается
+            raise ValueError(f'Политика очереди новых бар {policy} не поддерживается. Поддерживаются: {", ".join(self.policies)}')
+        self.maxlen = maxlen  # Максимальное кол-во бар в очереди
+        self.policy = policy  # Политика переполнения очереди
+        self.block_sec = block_sec  # Максимальное время ожидания места в очереди
+        self.bars = deque()  # Бары и время их постановки в очередь
+        self.condition = Condition()  # Условие прихода нового бара и освобождения места в очереди
+        self.closed = False  # Очередь закрыта. Бары больше не ставятся
+        self.drops = 0  # Кол-во удаленных при переполнении бар
+        self.get_time = perf_counter()  # Время последнего обращения данных к очереди. По нему находятся очереди, которые никто не разбирает
+
+    def put(self, bar) -> Union[str, None]:
+        """Постановка бара в очередь
+
+        :param Bar bar: Бар
+        :return: Причина потери бара: coalesced - заменен новым баром, overflow - удален при переполнении, block_timeout - удален после ожидания места. None - бары не потеряны
+        """
+        with self.condition:
+            if self.closed:  # Если очередь закрыта
+                return None  # то бар не ставим
+            if self.policy == 'coalesce' and self.bars and self.bars[-1][0].seconds == bar.seconds:  # Если последний бар в очереди с той же датой и временем открытия
+                self.bars[-1] = (bar, self.bars[-1][1])  # то заменяем его. Время постановки оставляем, чтобы видеть задержку выдачи
+                self.condition.notify_all()  # Будим данные, ожидающие новый бар
+                return 'coalesced'
+            reason = None  # Бары не потеряны
+            if self.policy == 'block' and self.maxlen and len(self.bars) >= self.maxlen:  # Если очередь заполнена, и нужно ждать места
+                if not self.condition.wait_for(lambda: self.closed or len(self.bars) < self.maxlen, self.block_sec):  # Если место не освободилось
+                    reason = 'block_timeout'  # то удалим самый старый бар
+                if self.closed:  # Если очередь закрыли, пока ждали
+                    return None  # то бар не ставим
+            if self.maxlen and len(self.bars) >= self.maxlen:  # Если очередь заполнена
+                self.bars.popleft()  # то удаляем самый старый бар
+                self.drops += 1
+                reason = reason or 'overflow'
+            self.bars.append((bar, perf_counter()))  # Ставим бар с временем постановки
+            self.condition.notify_all()  # Будим данные, ожидающие новый бар
+            return reason
+
+    def wait(self, timeout) -> bool:
+        """Ожидание нового бара
+
+        :param float timeout: Максимальное время ожидания в секундах
+        :return: True - в очереди есть бар, False - бар за время ожидания не пришел
+        """
+        with self.condition:
+            self.get_time = perf_counter()  # Данные разбирают очередь
+            return self.condition.wait_for(lambda: len(self.bars) > 0, timeout)
+
+    def popleft(self) -> tuple:
+        """Первый бар и время его постановки в очередь с удалением из очереди"""
+        with self.condition:
+            self.get_time = perf_counter()  # Данные разбирают очередь
+            item = self.bars.popleft()
+            self.condition.notify_all()  # Будим поток, ожидающий места в очереди
+            return item
+
+    def close(self) -> None:
+        """Закрытие очереди. Бары удаляются, ожидающий места поток освобождается"""
+        with self.condition:
+            self.closed = True
+            self.bars.clear()
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.bars)
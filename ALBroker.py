@@ -2,6 +2,9 @@ import logging  # Будем вести лог
 from typing import Union  # Объединение типов
 from collections import defaultdict, OrderedDict, deque  # Словари и очередь
 from datetime import datetime
+from time import perf_counter  # Время для метрик
+from threading import RLock  # Блокировка обработки ответов на асинхронную постановку заявок
+from concurrent.futures import ThreadPoolExecutor  # Пул потоков для асинхронной постановки заявок
 
 from backtrader import BrokerBase, Order, BuyOrder, SellOrder
 from backtrader.position import Position
@@ -21,6 +24,10 @@ class MetaALBroker(BrokerBase.__class__):
 class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
     """Брокер Алор"""
     logger = logging.getLogger(f'ALBroker')  # Будем вести лог
+    params = (
+        ('async_orders', False),  # Асинхронная постановка заявок. buy/sell сразу возвращают отправленную заявку (Submitted), принятие/отклонение приходит в уведомлениях
+    )
+    order_workers = 8  # Кол-во одновременных запросов на постановку заявок в асинхронном режиме
 
     def __init__(self, **kwargs):
         super(ALBroker, self).__init__()
@@ -29,9 +36,24 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
         self.startingcash = self.cash = 0  # Стартовые и текущие свободные средства
         self.startingvalue = self.value = 0  # Стартовая и текущая стоимость позиций
         self.positions = defaultdict(Position)  # Список позиций
+        self.cash_totals = defaultdict(float)  # Свободные средства по всем счетам (None), по портфелю (portfolio), по портфелю/бирже ((portfolio, exchange))
+        self.value_totals = defaultdict(float)  # Стоимость позиций по всем счетам (None), по портфелю (portfolio), по портфелю/бирже ((portfolio, exchange))
+        self.accounts = defaultdict(list)  # Счета по номеру. У одного номера может быть несколько портфелей с разными режимами торгов
+        for account in self.store.provider.accounts:  # Пробегаемся по всем счетам
+            self.accounts[account['account_id']].append(account)  # Портфели оставляем в порядке провайдера
         self.orders = OrderedDict()  # Список заявок, отправленных на биржу
-        self.ocos = {}  # Список связанных заявок (One Cancel Others)
-        self.pcs = defaultdict(deque)  # Очередь всех родительских/дочерних заявок (Parent - Children)
+        self.order_numbers = {}  # Активные заявки BackTrader по номеру заявки на бирже. Завершенные заявки удаляются
+        self.ocos = {}  # Группы связанных заявок (One Cancel Others) по номеру каждой заявки группы. Все заявки группы ссылаются на одну группу: заявки по номеру
+        self.pcs = {}  # Дочерние заявки по номеру родительской заявки (Parent - Children)
+        self.order_pool = None  # Пул потоков асинхронной постановки заявок
+        self.order_lock = RLock()  # Блокировка индекса заявок на время обработки ответа на постановку заявки
+        self.pending_orders = {}  # Заявки, отправленные асинхронно, ответ на постановку которых еще не пришел, по номеру заявки BackTrader
+        self.pending_cancels = set()  # Номера заявок BackTrader, отмененных до ответа на постановку
+        self.early_responses = defaultdict(list)  # События по заявкам, пришедшие до ответа на постановку, по номеру заявки на бирже
+        self.order_times = {}  # Время отправки заявки, после ответа на постановку - время ответа, для метрик по номеру заявки BackTrader. Удаляется после первой сделки
+        self.store.metrics.histogram('alor_order_ack_seconds', 'Время от отправки заявки до ответа на постановку')
+        self.store.metrics.histogram('alor_order_fill_seconds', 'Время от ответа на постановку заявки до первой сделки')
+        self.store.metrics.gauge('alor_broker_notifs_queue_depth', 'Кол-во уведомлений брокера в очереди', lambda: len(self.notifs))
 
         self.store.provider.on_position = self.on_position  # Обработка позиций
         self.store.provider.on_trade = self.on_trade  # Обработка сделок
@@ -40,25 +62,24 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
 
     def start(self):
         super(ALBroker, self).start()
+        if self.p.async_orders:  # Если заявки ставятся асинхронно
+            self.order_pool = ThreadPoolExecutor(max_workers=self.order_workers, thread_name_prefix='ALBrokerOrder')  # то создаем пул потоков постановки заявок
         self.get_all_active_positions()  # Получаем все активные позиции, в т.ч. денежные
+        self.store.save_metadata()  # Сохраняем полученную информацию о тикерах для следующего запуска
 
     def getcash(self, account_id=None, exchange=None):
         """Свободные средства по всем счетам, по портфелю/бирже"""
         if not self.store.BrokerCls:  # Если брокера нет в хранилище
             return 0
         if account_id is not None:  # Если считаем свободные средства по счету
-            account = next((account for account in self.store.provider.accounts if account['account_id'] == account_id), None)  # то пытаемся найти счет
+            account = next(iter(self.accounts.get(account_id, ())), None)  # то пытаемся найти счет
             if not account:  # Если счет не найден
                 self.logger.error(f'getcash: Счет номер {account_id} не найден. Проверьте правильность номера счета')
                 return 0
             portfolio = account['portfolio']  # Портфель
-            if exchange:  # Если считаем свободные средства по портфелю/бирже
-                cash = next((position.price for key, position in self.positions.items() if key[0] == portfolio and key[1] == exchange and not key[2]), None)  # Денежная позиция по портфелю/рынку
-            else:  # Если считаем свободные средства по портфелю
-                cash = next((position.price for key, position in self.positions.items() if key[0] == portfolio and not key[2]), None)  # Денежная позиция по портфелю
-        else:  # Если считаем свободные средства по всем счетам
-            cash = sum([position.price for key, position in self.positions.items() if not key[2]])  # Сумма всех денежных позиций
-        if account_id is None and cash:  # Если были получены все свободные средства
+            return self.cash_totals.get((portfolio, exchange) if exchange else portfolio, 0)  # Свободные средства по портфелю/бирже или по портфелю
+        cash = self.cash_totals.get(None, 0)  # Сумма всех денежных позиций
+        if cash:  # Если были получены все свободные средства
             self.cash = cash  # то сохраняем все свободные средства
         return self.cash
 
@@ -73,17 +94,14 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
                 position = self.positions[(data.portfolio, data.exchange, data.board, data.symbol)]  # Позиция по тикеру
                 value += position.price * position.size  # Добавляем стоимость позиции по тикеру
         elif account_id is not None:  # Если считаем свободные средства по счету
-            account = next((account for account in self.store.provider.accounts if account['account_id'] == account_id), None)  # то пытаемся найти счет
+            account = next(iter(self.accounts.get(account_id, ())), None)  # то пытаемся найти счет
             if not account:  # Если счет не найден
                 self.logger.error(f'getcash: Счет номер {account_id} не найден. Проверьте правильность номера счета')
                 return 0
             portfolio = account['portfolio']  # Портфель
-            if exchange:  # Если считаем свободные средства по портфелю/бирже
-                value = sum([position.price * position.size for key, position in self.positions.items() if key[0] == portfolio and key[1] == exchange and key[2]])  # Стоимость позиций по портфелю/бирже
-            else:  # Если считаем свободные средства по портфелю
-                value = sum([position.price * position.size for key, position in self.positions.items() if key[0] == portfolio and key[2]])  # Стоимость позиций по портфелю
+            value = self.value_totals.get((portfolio, exchange) if exchange else portfolio, 0)  # Стоимость позиций по портфелю/бирже или по портфелю
         else:  # Если считаем стоимость всех позиций
-            value = sum([position.price * position.size for key, position in self.positions.items() if key[2]])  # Стоимость всех позиций
+            value = self.value_totals.get(None, 0)  # Стоимость всех позиций
             self.value = value  # Сохраняем текущую стоимость позиций
         return value
 
@@ -99,13 +117,15 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
     def buy(self, owner, data, size, price=None, plimit=None, exectype=None, valid=None, tradeid=0, oco=None, trailamount=None, trailpercent=None, parent=None, transmit=True, **kwargs):
         """Заявка на покупку"""
         order = self.create_order(owner, data, size, price, plimit, exectype, valid, oco, parent, transmit, True, **kwargs)
-        self.notifs.append(order.clone())  # Уведомляем брокера о принятии/отклонении зявки на бирже
+        if not order.info.get('async_order'):  # При асинхронной постановке брокер уведомляется об отправке и принятии/отклонении заявки при получении ответа
+            self.notifs.append(order.clone())  # Уведомляем брокера о принятии/отклонении зявки на бирже
         return order
 
     def sell(self, owner, data, size, price=None, plimit=None, exectype=None, valid=None, tradeid=0, oco=None, trailamount=None, trailpercent=None, parent=None, transmit=True, **kwargs):
         """Заявка на продажу"""
         order = self.create_order(owner, data, size, price, plimit, exectype, valid, oco, parent, transmit, False, **kwargs)
-        self.notifs.append(order.clone())  # Уведомляем брокера о принятии/отклонении зявки на бирже
+        if not order.info.get('async_order'):  # При асинхронной постановке брокер уведомляется об отправке и принятии/отклонении заявки при получении ответа
+            self.notifs.append(order.clone())  # Уведомляем брокера о принятии/отклонении зявки на бирже
         return order
 
     def cancel(self, order):
@@ -120,6 +140,9 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
 
     def stop(self):
         super(ALBroker, self).stop()
+        if self.order_pool:  # Если заявки ставились асинхронно
+            self.order_pool.shutdown(wait=True)  # то дожидаемся ответов на все отправленные заявки
+            self.order_pool = None
         self.unsubscribe()  # Отменяем все подписки
         self.store.provider.on_position = self.store.provider.default_handler  # Обработка позиций
         self.store.provider.on_trade = self.store.provider.default_handler  # Обработка сделок
@@ -167,8 +190,8 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
 
     def get_all_active_positions(self):
         """Все активные позиции в т.ч. денежные по всем клиентским портфелям и биржам"""
-        cash = 0  # Будем набирать свободные средства
-        value = 0  # Будем набирать стоимость позиций
+        self.cash_totals.clear()  # Суммы свободных средств
+        self.value_totals.clear()  # и стоимости позиций набираем заново
         for account in self.store.provider.accounts:  # Пробегаемся по всем счетам
             portfolio = account['portfolio']  # Портфель
             for exchange in account['exchanges']:  # Пробегаемся по всем биржам
@@ -179,25 +202,75 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
                         board = ''  # Для свободных средств нет кода режима торгов
                         size = 1  # Кол-во
                         price = position['volume']  # Размер свободных средств
-                        cash += price  # Увеличиваем общий размер свободных средств
                     else:  # Если пришла позиция
-                        si = self.store.provider.get_symbol_info(exchange, symbol)  # Информация о тикере
+                        si = self.store.get_metadata('get_symbol_info', exchange, symbol)  # Информация о тикере из кэша
                         board = si['board']  # Код режима торгов
-                        size = self.store.provider.lots_to_size(exchange, symbol, position['qty'])  # Кол-во в штуках
-                        price = self.store.provider.alor_price_to_price(exchange, symbol, position['avgPrice'])  # Цена входа в рублях за штуку
-                        value += price * size  # Увеличиваем общий размер стоимости позиций
-                    self.positions[(portfolio, exchange, board, symbol)] = Position(size, price)  # Сохраняем в списке открытых позиций
-        self.cash = cash  # Сохраняем текущие свободные средства
-        self.value = value  # Сохраняем текущую стоимость позиций
+                        size = self.lots_to_size(exchange, symbol, position['qty'])  # Кол-во в штуках
+                        price = self.alor_price_to_price(exchange, symbol, position['avgPrice'])  # Цена входа в рублях за штуку
+                    self.set_position((portfolio, exchange, board, symbol), Position(size, price))  # Сохраняем в списке открытых позиций
+        self.cash = self.cash_totals[None]  # Сохраняем текущие свободные средства
+        self.value = self.value_totals[None]  # Сохраняем текущую стоимость позиций
+
+    def set_position(self, key, position: Position) -> None:
+        """Замена позиции с пересчетом сумм свободных средств и стоимости позиций
+
+        :param tuple key: Портфель, биржа, код режима торгов, тикер
+        :param Position position: Новая позиция
+        """
+        self.add_to_totals(key, -1)  # Убираем прошлую позицию из сумм
+        self.positions[key] = position  # Сохраняем новую позицию
+        self.add_to_totals(key, 1)  # Добавляем новую позицию в суммы
+
+    def add_to_totals(self, key, sign) -> None:
+        """Добавление (sign=1) или вычитание (sign=-1) позиции в суммах свободных средств или стоимости позиций по всем счетам, портфелю, портфелю/бирже
+
+        :param tuple key: Портфель, биржа, код режима торгов, тикер
+        :param int sign: 1 - добавление, -1 - вычитание
+        """
+        portfolio, exchange, board, _ = key  # Портфель, биржа, код режима торгов
+        position = self.positions.get(key)  # Позиция
+        if position is None:  # Если позиции нет
+            return  # то суммы не меняются
+        if board:  # Если позиция по тикеру
+            totals, amount = self.value_totals, position.price * position.size  # то меняется стоимость позиций
+        else:  # Если денежная позиция (нет кода режима торгов)
+            totals, amount = self.cash_totals, position.price  # то меняются свободные средства
+        amount *= sign  # Добавляем или вычитаем
+        totals[None] += amount  # По всем счетам
+        totals[portfolio] += amount  # По портфелю
+        totals[(portfolio, exchange)] += amount  # По портфелю/бирже
+
+    def alor_price_to_price(self, exchange, symbol, alor_price) -> float:
+        """Перевод цены Алор в цену в рублях за штуку по коэффициенту из кэша хранилища. Коэффициент общий с данными, запроса к провайдеру на каждую позицию нет"""
+        return alor_price * self.store.get_metadata('alor_price_to_price', exchange, symbol, ALData.ratio_base) / ALData.ratio_base
+
+    def lots_to_size(self, exchange, symbol, lots) -> int:
+        """Перевод кол-ва лотов в кол-во штук по коэффициенту из кэша хранилища. Коэффициент общий с данными, запроса к провайдеру на каждую позицию нет"""
+        return int(lots * self.store.get_metadata('lots_to_size', exchange, symbol, ALData.ratio_base) / ALData.ratio_base)
 
     def get_order(self, order_number) -> Union[Order, None]:
         """Заявка BackTrader по номеру заявки на бирже
-        Пробегаемся по всем заявкам на бирже. Если нашли совпадение с номером заявки на бирже, то возвращаем заявку BackTrader. Иначе, ничего не найдено
+        Ищем по индексу активных заявок. Если заявка завершена или не из автоторговли, то ничего не найдено
 
         :param order_number: Номер заявки на бирже
         :return: Заявка BackTrader или None
         """
-        return next((order for order in self.orders.values() if order.info['order_number'] == order_number), None)
+        return self.order_numbers.get(order_number)
+
+    def get_order_or_stash(self, order_number, handler, response) -> Union[Order, None]:
+        """Заявка BackTrader по номеру заявки на бирже для обработки события
+        Если заявка не найдена, а ответы на асинхронную постановку заявок еще не пришли, то событие будет обработано после ответа
+
+        :param str order_number: Номер заявки на бирже
+        :param handler: Обработчик события
+        :param dict response: Событие
+        :return: Заявка BackTrader или None, если заявка не найдена
+        """
+        with self.order_lock:  # Ответ на постановку может прийти во время проверки
+            order = self.get_order(order_number)  # Заявка BackTrader
+            if not order and self.pending_orders:  # Если заявка не найдена, но есть заявки без ответа на постановку
+                self.early_responses[order_number].append((handler, response))  # то событие может относиться к одной из них
+            return order
 
     def create_order(self, owner, data: ALData, size, price=None, plimit=None, exectype=None, valid=None, oco=None, parent=None, transmit=True, is_buy=True, **kwargs):
         """Создание заявки. Привязка параметров счета и тикера. Обработка связанных и родительской/дочерних заявок
@@ -214,8 +287,8 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
             self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки
             return order  # Возвращаем отклоненную заявку
         account_id = 0 if 'account_id' not in order.info else order.info['account_id']  # Получаем номер счета, если его передали. Иначе, получаем счет по умолчанию
-        account = next((account for account in self.store.provider.accounts if account['account_id'] == account_id and data.board in account['boards']), None)  # Получаем счет по номеру и режиму торгов
-        if not account:  # Если счет не найден
+        account = next((account for account in self.accounts.get(account_id, ()) if data.board in account['boards']), None)  # Получаем счет по номеру и режиму торгов
+        if not account:  # Если счет не найден или на нем нет режима торгов тикера
             self.logger.error(f'create_order: Постановка заявки {order.ref} по тикеру {data.board}.{data.symbol} отменена. Не найден счет')
             order.reject(self)  # то отменяем заявку (статус Order.Rejected)
             return order  # Возвращаем отмененную заявку
@@ -236,16 +309,26 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
             return order  # Возвращаем отклоненную заявку
 
         if oco:  # Если есть связанная заявка
-            self.ocos[order.ref] = oco.ref  # то заносим в список связанных заявок
+            with self.order_lock:  # Группу могут менять при завершении заявок из других потоков
+                group = self.ocos.get(oco.ref)  # Группа связанной заявки
+                if group is None:  # Если связанная заявка еще не в группе
+                    group = self.ocos[oco.ref] = {oco.ref: oco}  # то создаем группу из нее
+                group[order.ref] = order  # Добавляем заявку в группу
+                self.ocos[order.ref] = group  # Заявка ссылается на ту же группу
         if not transmit or parent:  # Для родительской/дочерних заявок
-            parent_ref = getattr(order.parent, 'ref', order.ref)  # Номер транзакции родительской заявки или номер заявки, если родительской заявки нет
-            if order.ref != parent_ref and parent_ref not in self.pcs:  # Если есть родительская заявка, но она не найдена в очереди родительских/дочерних заявок
+            parent_found = True  # Родительская заявка найдена
+            with self.order_lock:  # Дочерние заявки могут менять при завершении заявок из других потоков
+                if not parent:  # Для родительской заявки
+                    self.pcs[order.ref] = []  # заводим пустой список дочерних заявок
+                elif parent.ref in self.pcs:  # Если родительская заявка найдена
+                    self.pcs[parent.ref].append(order)  # то добавляем к ней дочернюю заявку
+                else:  # Если родительская заявка не найдена
+                    parent_found = False
+            if not parent_found:  # Если есть родительская заявка, но она не найдена в списке родительских заявок
                 self.logger.warning(f'Постановка заявки {order.ref} по тикеру {data.board}.{data.symbol} на бирже {data.exchange} отклонена. Родительская заявка не найдена')
                 order.reject(self)  # то отклоняем заявку
                 self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки
                 return order  # Возвращаем отклоненную заявку
-            pcs = self.pcs[parent_ref]  # В очередь к родительской заявке
-            pcs.append(order)  # добавляем заявку (родительскую или дочернюю)
         if transmit:  # Если обычная заявка или последняя дочерняя заявка
             if not parent:  # Для обычных заявок
                 return self.place_order(order)  # Отправляем заявку на биржу
@@ -265,20 +348,19 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
         quantity = abs(order.size if order.data.derivative else self.store.provider.size_to_lots(exchange, symbol, order.size))  # Размер позиции в лотах. В Алор всегда передается положительный размер лота
         if order.data.derivative:  # Для деривативов
             order.size = self.store.provider.lots_to_size(exchange, symbol, order.size)  # сохраняем в заявку размер позиции в штуках
-        response = None  # Результат запроса
         if order.exectype == Order.Market:  # Рыночная заявка
-            response = self.store.provider.create_market_order(portfolio, exchange, symbol, side, quantity)
+            request = self.store.provider.create_market_order, (portfolio, exchange, symbol, side, quantity)
         elif order.exectype == Order.Limit:  # Лимитная заявка
             limit_price = self.store.provider.price_to_valid_price(exchange, symbol, order.price) if order.data.derivative else self.store.provider.price_to_alor_price(exchange, symbol, order.price)  # Лимитная цена
             if order.data.derivative:  # Для деривативов
                 order.price = self.store.provider.alor_price_to_price(exchange, symbol, order.price)  # Сохраняем в заявку лимитную цену заявки в рублях за штуку
-            response = self.store.provider.create_limit_order(portfolio, exchange, symbol, side, quantity, limit_price)
+            request = self.store.provider.create_limit_order, (portfolio, exchange, symbol, side, quantity, limit_price)
         elif order.exectype == Order.Stop:  # Стоп заявка
             stop_price = self.store.provider.price_to_valid_price(exchange, symbol, order.price) if order.data.derivative else self.store.provider.price_to_alor_price(exchange, symbol, order.price)  # Стоп цена
             if order.data.derivative:  # Для деривативов
                 order.price = self.store.provider.alor_price_to_price(exchange, symbol, order.price)  # Сохраняем в заявку стоп цену заявки в рублях за штуку
             condition = 'MoreOrEqual' if order.isbuy() else 'LessOrEqual'  # Условие срабатывания стоп цены
-            response = self.store.provider.create_stop_order(portfolio, exchange, symbol, class_code, side, quantity, stop_price, condition)
+            request = self.store.provider.create_stop_order, (portfolio, exchange, symbol, class_code, side, quantity, stop_price, condition)
         elif order.exectype == Order.StopLimit:  # Стоп-лимитная заявка
             stop_price = self.store.provider.price_to_valid_price(exchange, symbol, order.price) if order.data.derivative else self.store.provider.price_to_alor_price(exchange, symbol, order.price)  # Стоп цена
             limit_price = self.store.provider.price_to_valid_price(exchange, symbol, order.pricelimit) if order.data.derivative else self.store.provider.price_to_alor_price(exchange, symbol, order.pricelimit)  # Лимитная цена
@@ -286,23 +368,66 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
                 order.price = self.store.provider.alor_price_to_price(exchange, symbol, order.price) if order.data.derivative else stop_price  # Сохраняем в заявку стоп цену заявки в рублях за штуку
                 order.pricelimit = self.store.provider.alor_price_to_price(exchange, symbol, order.pricelimit) if order.data.derivative else limit_price  # Сохраняем в заявку лимитную цену заявки в рублях за штуку
             condition = 'MoreOrEqual' if order.isbuy() else 'LessOrEqual'  # Условие срабатывания стоп цены
-            response = self.store.provider.create_stop_limit_order(portfolio, exchange, symbol, class_code, side, quantity, stop_price, limit_price, condition)
+            request = self.store.provider.create_stop_limit_order, (portfolio, exchange, symbol, class_code, side, quantity, stop_price, limit_price, condition)
+        else:  # Для остальных типов заявок
+            request = None  # запрос не отправляем. Заявка будет отклонена
         order.submit(self)  # Отправляем заявку на биржу (Order.Submitted)
+        self.order_times[order.ref] = perf_counter()  # Время отправки заявки
         self.notifs.append(order.clone())  # Уведомляем брокера об отправке заявки на биржу
+        if request and self.order_pool:  # Если заявки ставятся асинхронно
+            order.addinfo(async_order=True)  # Заявка поставлена асинхронно
+            self.pending_orders[order.ref] = order  # Ждем ответа на постановку заявки
+            future = self.order_pool.submit(request[0], *request[1])  # Отправляем запрос в пуле потоков
+            future.add_done_callback(lambda f: self.on_place_order(order, None if f.cancelled() or f.exception() else f.result()))  # Ответ обработаем по приходу
+            return order  # Возвращаем отправленную заявку, не дожидаясь ответа
+        return self.on_place_order(order, request[0](*request[1]) if request else None)  # Отправляем заявку и обрабатываем ответ
+
+    def on_place_order(self, order: Order, response):
+        """Обработка ответа на постановку заявки
+
+        :param Order order: Отправленная заявка
+        :param dict response: Ответ на запрос постановки заявки. None - ошибка
+        :return: Принятая или отклоненная заявка
+        """
         if not response:  # Если при отправке заявки на биржу произошла веб ошибка
-            self.logger.warning(f'Постановка заявки по тикеру {class_code}.{symbol} на бирже {exchange} отклонена. Ошибка веб сервиса')
-            order.reject(self)  # то отклоняем заявку
+            self.logger.warning(f'Постановка заявки по тикеру {order.data.board}.{order.data.symbol} на бирже {order.data.exchange} отклонена. Ошибка веб сервиса')
+            with self.order_lock:  # Изменяем заявки только из одного потока
+                order.reject(self)  # то отклоняем заявку
+                self.order_times.pop(order.ref, None)  # Сделок по заявке не будет
+                if self.pending_orders.pop(order.ref, None):  # Если заявка ставилась асинхронно
+                    self.notifs.append(order.clone())  # то уведомляем брокера об отклонении заявки
+                self.pending_cancels.discard(order.ref)  # Отклоненную заявку отменять не нужно
             self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки
             return order  # Возвращаем отклоненную заявку
-        order.addinfo(order_number=response['orderNumber'])  # Сохраняем пришедший номер заявки на бирже
-        order.accept(self)  # Заявка принята на бирже (Order.Accepted)
-        self.orders[order.ref] = order  # Сохраняем заявку в списке заявок, отправленных на биржу
+        with self.order_lock:  # События по заявке, пришедшие до постановки, не должны потеряться
+            order.addinfo(order_number=response['orderNumber'])  # Сохраняем пришедший номер заявки на бирже
+            self.order_numbers[order.info['order_number']] = order  # Добавляем заявку в индекс активных заявок по номеру на бирже
+            order.accept(self)  # Заявка принята на бирже (Order.Accepted)
+            ack_time = perf_counter()  # Время ответа на постановку
+            self.store.metrics.observe('alor_order_ack_seconds', ack_time - self.order_times.get(order.ref, ack_time))  # Время от отправки заявки до ответа
+            self.order_times[order.ref] = ack_time  # Время до первой сделки считаем от ответа
+            self.orders[order.ref] = order  # Сохраняем заявку в списке заявок, отправленных на биржу
+            if self.pending_orders.pop(order.ref, None):  # Если заявка ставилась асинхронно
+                self.notifs.append(order.clone())  # то уведомляем брокера о принятии заявки
+            early_responses = self.early_responses.pop(order.info['order_number'], [])  # События по заявке, пришедшие до ответа на постановку
+            if not self.pending_orders:  # Если ответы на все заявки получены
+                self.early_responses.clear()  # то остальные события не относятся к заявкам BackTrader
+            cancel = order.ref in self.pending_cancels  # Заявку отменили до ответа на постановку
+            self.pending_cancels.discard(order.ref)
+            for handler, early_response in early_responses:  # Пробегаемся по всем событиям заявки, пришедшим до ответа на постановку
+                handler(early_response)  # Обрабатываем событие. Новые события по заявке ждут блокировку и обрабатываются после пришедших раньше
+        if cancel:  # Если заявку отменили до ответа на постановку
+            self.cancel_order(order)  # то отменяем ее
         return order  # Возвращаем заявку
 
     def cancel_order(self, order):
         """Отмена заявки"""
         if not order.alive():  # Если заявка уже была завершена
             return  # то выходим, дальше не продолжаем
+        with self.order_lock:  # Ответ на постановку может прийти во время проверки
+            if order.ref in self.pending_orders:  # Если ответ на асинхронную постановку заявки еще не пришел
+                self.pending_cancels.add(order.ref)  # то отменим заявку после ответа
+                return order
         if order.ref not in self.orders:  # Если заявка не найдена
             return  # то выходим, дальше не продолжаем
         portfolio = order.info['account']['portfolio']  # Портфель
@@ -316,25 +441,35 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
         """
         Проверка связанных заявок
         Проверка родительской/дочерних заявок
+        Вызывается при завершении заявки. Просматриваются только группа заявки и дочерние заявки ее родительской заявки
         """
-        ocos = self.ocos.copy()  # Пока ищем связанные заявки, они могут измениться. Поэтому, работаем с копией
-        for order_ref, oco_ref in ocos.items():  # Пробегаемся по списку связанных заявок
-            if oco_ref == order.ref:  # Если в заявке номер эта заявка указана как связанная (по номеру транзакции)
-                self.cancel_order(self.orders[order_ref])  # то отменяем заявку
-        if order.ref in ocos.keys():  # Если у этой заявки указана связанная заявка
-            oco_ref = ocos[order.ref]  # то получаем номер транзакции связанной заявки
-            self.cancel_order(self.orders[oco_ref])  # отменяем связанную заявку
-
-        if not order.parent and not order.transmit and order.status == Order.Completed:  # Если исполнена родительская заявка
-            pcs = self.pcs[order.ref]  # Получаем очередь родительской/дочерних заявок
-            for child in pcs:  # Пробегаемся по всем заявкам
-                if child.parent:  # Пропускаем первую (родительскую) заявку
-                    self.place_order(child)  # Отправляем дочернюю заявку на биржу
-        elif order.parent:  # Если исполнена/отменена дочерняя заявка
-            pcs = self.pcs[order.parent.ref]  # Получаем очередь родительской/дочерних заявок
-            for child in pcs:  # Пробегаемся по всем заявкам
-                if child.parent and child.ref != order.ref:  # Пропускаем первую (родительскую) заявку и исполненную заявку
-                    self.cancel_order(child)  # Отменяем дочернюю заявку
+        cancels = []  # Заявки к отмене
+        places = []  # Дочерние заявки к отправке на биржу
+        with self.order_lock:  # Группы и дочерние заявки могут менять из других потоков. Заявки на биржу отправляем/отменяем вне блокировки
+            group = self.ocos.pop(order.ref, None)  # Группа связанных заявок
+            if group is not None:  # Если заявка в группе
+                group.pop(order.ref, None)  # то убираем ее из группы
+                for oco_ref, oco in group.items():  # Пробегаемся по остальным заявкам группы
+                    self.ocos.pop(oco_ref, None)  # Группа завершена. Убираем из нее все заявки
+                    cancels.append(oco)  # Связанную заявку отменяем
+                group.clear()
+
+            if not order.parent and not order.transmit:  # Если завершена родительская заявка
+                if order.status == Order.Completed:  # Если родительская заявка исполнена
+                    places = list(self.pcs.get(order.ref, []))  # то дочерние заявки отправим на биржу. Оставляем их до завершения одной из них
+                    if not places:  # Если дочерних заявок нет
+                        self.pcs.pop(order.ref, None)  # то удаляем родительскую заявку
+                else:  # Если родительская заявка отменена/отклонена
+                    self.pcs.pop(order.ref, None)  # то дочерние заявки на биржу не попадут
+            elif order.parent:  # Если исполнена/отменена дочерняя заявка
+                children = self.pcs.get(order.parent.ref, [])  # Дочерние заявки родительской заявки
+                if any(child is order for child in children):  # Если заявка есть среди дочерних (не отклонена до добавления)
+                    del self.pcs[order.parent.ref]  # то родительская/дочерние заявки завершены
+                    cancels.extend(child for child in children if child is not order)  # Остальные дочерние заявки отменяем
+        for oco in cancels:  # Пробегаемся по всем заявкам к отмене
+            self.cancel_order(oco)  # Отменяем заявку
+        for child in places:  # Пробегаемся по всем дочерним заявкам
+            self.place_order(child)  # Отправляем дочернюю заявку на биржу
 
     def on_position(self, response):
         """Обработка позиций"""
@@ -343,15 +478,15 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
         exchange = position['exchange']  # Биржа
         symbol = position['symbol']  # Тикер
         if position['isCurrency']:  # Если пришли валютные остатки (деньги)
-            board = None  # Для свободных средств нет кода режима торгов
+            board = ''  # Для свободных средств нет кода режима торгов
             size = 1  # Кол-во свободных средств
             price = position['volume']  # Размер свободных средств
         else:  # Если пришла позиция
-            si = self.store.provider.get_symbol_info(exchange, symbol)  # Информация о тикере
+            si = self.store.get_metadata('get_symbol_info', exchange, symbol)  # Информация о тикере из кэша
             board = si['board']  # Код режима торгов
             size = position['qty'] * si['lotsize']  # Кол-во в штуках
-            price = self.store.provider.alor_price_to_price(exchange, symbol, position['avgPrice'])  # Цена входа в рублях за штуку
-        self.positions[(portfolio, exchange, board, symbol)] = Position(size, price)  # Сохраняем в списке открытых позиций
+            price = self.alor_price_to_price(exchange, symbol, position['avgPrice'])  # Цена входа в рублях за штуку
+        self.set_position((portfolio, exchange, board, symbol), Position(size, price))  # Сохраняем в списке открытых позиций
 
     def on_order(self, response):
         """Обработка рыночных и лимитных заявок на отмену (canceled). Статусы working, filled, rejected обрабатываются в place_order и on_trade"""
@@ -360,10 +495,13 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
         if status != 'canceled':  # Для рыночной или лимитной заявки интересует только отмена заявки
             return  # иначе, выходим, дальше не продолжаем
         order_number = data['id']  # Номер заявки из сделки
-        order: Order = self.get_order(order_number)  # Заявка BackTrader
+        order: Order = self.get_order_or_stash(order_number, self.on_order, response)  # Заявка BackTrader
         if not order:  # Если заявки нет в BackTrader (не из автоторговли)
             return  # то выходим, дальше не продолжаем
         order.cancel()  # Отменяем существующую заявку
+        with self.order_lock:  # Индекс заявок меняют и из других потоков
+            self.order_numbers.pop(order_number, None)  # Удаляем завершенную заявку из индекса активных заявок. Ее могли уже удалить
+        self.order_times.pop(order.ref, None)  # Сделок по заявке больше не будет
         self.notifs.append(order.clone())  # Уведомляем брокера об отмене заявки
         self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки (Canceled)
 
@@ -374,13 +512,16 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
         if status not in ('filled', 'canceled'):  # Для стоп-заявки интересует отмена и исполнение, которое не приводит к сделке
             return  # иначе, выходим, дальше не продолжаем
         order_number = data['id']  # Номер заявки из сделки
-        order: Order = self.get_order(order_number)  # Заявка BackTrader
+        order: Order = self.get_order_or_stash(order_number, self.on_stop_order_v2, response)  # Заявка BackTrader
         if not order:  # Если заявки нет в BackTrader (не из автоторговли)
             return  # то выходим, дальше не продолжаем
         if status == 'filled':  # Для исполненной стоп-заявки
             order.completed()  # Заявка полностью исполнена
         else:  # Для отмененной рыночной, лимитной, стоп-заявки
             order.cancel()  # Отменяем существующую заявку
+        with self.order_lock:  # Индекс заявок меняют и из других потоков
+            self.order_numbers.pop(order_number, None)  # Удаляем завершенную заявку из индекса активных заявок. Ее могли уже удалить
+        self.order_times.pop(order.ref, None)  # Сделок по заявке больше не будет
         self.notifs.append(order.clone())  # Уведомляем брокера об отмене заявки
         self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки (Canceled)
 
@@ -390,7 +531,7 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
         if data['existing']:  # При (пере)подключении к серверу передаются сделки как из истории, так и новые. Если сделка из истории
             return  # то выходим, дальше не продолжаем
         order_no = data['orderno']  # Номер заявки из сделки
-        order = self.get_order(order_no)  # Заявка BackTrader
+        order = self.get_order_or_stash(order_no, self.on_trade, response)  # Заявка BackTrader
         if not order:  # Если заявки нет в BackTrader (не из автоторговли)
             return  # то выходим, дальше не продолжаем
         size = data['qtyUnits']  # Кол-во в штуках. Всегда положительное
@@ -400,15 +541,23 @@ class ALBroker(with_metaclass(MetaALBroker, BrokerBase)):
         str_utc = data['date'][:19]  # Возвращается значение типа: '2023-02-16T09:25:01.4335364Z'. Берем первые 20 символов до точки перед наносекундами
         dt_utc = datetime.strptime(str_utc, '%Y-%m-%dT%H:%M:%S')  # Переводим в дату/время UTC
         dt = self.store.provider.utc_to_msk_datetime(dt_utc)  # Дата и время сделки по времени биржи (МСК)
-        pos = self.getposition(order.data)  # Получаем позицию по тикеру или нулевую позицию если тикера в списке позиций нет
+        key = (order.data.portfolio, order.data.exchange, order.data.board, order.data.symbol)  # Позиция по тикеру
+        pos = self.positions[key]  # Получаем позицию по тикеру или нулевую позицию если тикера в списке позиций нет
+        self.add_to_totals(key, -1)  # Убираем позицию до сделки из сумм
         psize, pprice, opened, closed = pos.update(size, price)  # Обновляем размер/цену позиции на размер/цену сделки
+        self.add_to_totals(key, 1)  # Добавляем позицию после сделки в суммы
         order.execute(dt, size, price, closed, 0, 0, opened, 0, 0, 0, 0, psize, pprice)  # Исполняем заявку в BackTrader
+        ack_time = self.order_times.pop(order.ref, None)  # Время ответа на постановку. Есть только до первой сделки
+        if ack_time is not None:  # Если это первая сделка по заявке
+            self.store.metrics.observe('alor_order_fill_seconds', perf_counter() - ack_time)  # то время от ответа на постановку до первой сделки
         if order.executed.remsize:  # Если осталось что-то к исполнению
             if order.status != order.Partial:  # Если заявка переходит в статус частичного исполнения (может исполняться несколькими частями)
                 order.partial()  # то заявка частично исполнена
                 self.notifs.append(order.clone())  # Уведомляем брокера о частичном исполнении заявки
         else:  # Если ничего нет к исполнению
             order.completed()  # то заявка полностью исполнена
+            with self.order_lock:  # Индекс заявок меняют и из других потоков
+                self.order_numbers.pop(order_no, None)  # Удаляем завершенную заявку из индекса активных заявок. Ее могли уже удалить
             self.notifs.append(order.clone())  # Уведомляем брокера о полном исполнении заявки
             # Снимаем oco-заявку только после полного исполнения заявки
             # Если нужно снять oco-заявку на частичном исполнении, то прописываем это правило в ТС
@@ -1,16 +1,25 @@
 import logging  # Будем вести лог
+from typing import Union  # Объединение типов
 from datetime import datetime, timedelta, time, UTC
-from time import sleep
 from uuid import uuid4  # Номера расписаний должны быть уникальными во времени и пространстве
-from threading import Thread, Event  # Поток и событие остановки потока получения новых бар по расписанию биржи
+from collections import deque  # Очередь исторических бар
+from concurrent.futures import ThreadPoolExecutor  # Пул потоков для параллельной загрузки частей истории
+from math import fsum  # Точная сумма для перевода даты и времени в формат BackTrader
+from array import array  # Колонки бинарного файла истории
+from bisect import bisect_left, bisect_right  # Двоичный поиск по отсортированным датам и времени бар
+from calendar import timegm  # Дата и время в кол-во секунд без учета временнОй зоны
+from time import perf_counter  # Время для метрик
 import os.path
+import io  # Чтение текстового файла истории с заданного смещения
+import mmap  # Отображение бинарного файла истории в память
 import csv
 
 from backtrader.feed import AbstractDataBase
 from backtrader.utils.py3 import with_metaclass
-from backtrader import TimeFrame, date2num
+from backtrader import TimeFrame
 
 from BackTraderAlor import ALStore
+from BackTraderAlor.ALBar import Bar, Bars
 
 
 class MetaALData(AbstractDataBase.__class__):
@@ -27,86 +36,137 @@ class ALData(with_metaclass(MetaALData, AbstractDataBase)):
         ('four_price_doji', False),  # False - не пропускать дожи 4-х цен, True - пропускать
         ('schedule', None),  # Расписание работы биржи. Если не задано, то берем из подписки
         ('live_bars', False),  # False - только история, True - история и новые бары
+        ('binary_file', False),  # False - текстовый файл истории, True - бинарный файл истории в колонках с разбивкой по периодам
+        ('offline', False),  # True - без подключения к Алор. Информация о тикере из кэша хранилища, бары только из файла истории
+        ('base_tf', None),  # Временной интервал файла истории, из которого строятся бары. Например, 'M1' для M5, M15, M60, D1. None - не строить
     )
     datapath = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Data', 'Alor', '')  # Путь сохранения файла истории
     delimiter = '\t'  # Разделитель значений в файле истории. По умолчанию табуляция
     dt_format = '%d.%m.%Y %H:%M'  # Формат представления даты и времени в файле истории. По умолчанию русский формат
-    sleep_time_sec = 1  # Время ожидания в секундах, если не пришел новый бар. Для снижения нагрузки/энергопотребления процессора
+    bin_partition = '%Y'  # Разбивка бинарного файла истории на периоды. '%Y' - по годам, '%Y%m' - по месяцам
+    index_step = 1000  # Через сколько строк текстового файла истории делать запись в индекс
+    csv_header = ('datetime', 'open', 'high', 'low', 'close', 'volume')  # Заголовок текстового файла истории
+    bin_columns = (('datetime', 'q'), ('open', 'd'), ('high', 'd'), ('low', 'd'), ('close', 'd'), ('volume', 'q'))  # Колонки бинарного файла истории и их типы. Дата и время в кол-ве секунд с 01.01.1970 00:00
+    sleep_time_sec = 1  # Максимальное время ожидания в секундах, если не пришел новый бар. Новый бар будит данные сразу
     delta = 3  # Корректировка в секундах при проверке времени окончания бара
+    ratio_base = 1_000_000  # Значение, на котором один раз получаем коэффициенты перевода цены и кол-ва. Большое, чтобы не влияло округление
+    history_chunk_bars = 200_000  # Максимальное кол-во бар истории в памяти при загрузке. История загружается параллельно частями, каждая часть по порядку сохраняется в файл
+    history_workers = 4  # Кол-во частей истории, загружаемых одновременно. Каждая часть не больше history_chunk_bars // history_workers бар. 1 - загрузка одной частью history_chunk_bars бар
+    flush_bars = 1  # Через сколько новых бар сбрасывать буфер файла истории на диск. 0 - только при остановке
+    fsync = False  # True - после сброса буфера дожидаться физической записи файла истории на диск
 
     def islive(self):
         """Если подаем новые бары, то Cerebro не будет запускать preload и runonce, т.к. новые бары должны идти один за другим"""
-        return self.p.live_bars
+        return self.p.live_bars and not self.p.offline  # Без подключения к Алор только история из файла
 
     def __init__(self, **kwargs):
         self.store = ALStore(**kwargs)  # Хранилище Алор
         self.intraday = self.p.timeframe in (TimeFrame.Minutes, TimeFrame.Seconds)  # Внутридневной временной интервал. Алор измеряет внутридневные интервалы в секундах
-        self.board, self.symbol = self.store.provider.dataname_to_alor_board_symbol(self.p.dataname)  # По тикеру получаем код режима торгов и тикера
-        self.derivative = self.board == 'RFUD'  # Для деривативов не используем конвертацию цен и кол-ва
-        self.exchange = self.store.provider.get_exchange(self.board, self.symbol)  # Биржа тикера. В Алор запросы выполняются по коду биржи и тикера
-        self.lotsize = self.store.provider.get_symbol(self.exchange, self.symbol)['lotsize']  # Размер лота
-        self.portfolio = self.store.provider.get_account(self.board, self.p.account_id)['portfolio']  # Портфель тикера
         self.alor_timeframe = self.bt_timeframe_to_alor_timeframe(self.p.timeframe, self.p.compression)  # Конвертируем временной интервал из BackTrader в Алор
         self.tf = self.bt_timeframe_to_tf(self.p.timeframe, self.p.compression)  # Конвертируем временной интервал из BackTrader для имени файла истории и расписания
-        self.file = f'{self.board}.{self.symbol}_{self.tf}'  # Имя файла истории
-        self.logger = logging.getLogger(f'ALData.{self.file}')  # Будем вести лог
-        self.file_name = f'{self.datapath}{self.file}.txt'  # Полное имя файла истории
-        self.history_bars = []  # Исторические бары из файла и истории после проверки на соответствие условиям выборки
+        self.logger = logging.getLogger(f'ALData.{self.p.dataname}_{self.tf}')  # Будем вести лог. После получения информации о тикере лог будет вестись по имени файла истории
+        self.warm_up_future = None  # Подготовка данных, запущенная хранилищем параллельно с другими данными
+        self.history_bars = Bars()  # Исторические бары из файла и истории после проверки на соответствие условиям выборки. Хранятся в колонках
         self.guid = None  # Идентификатор подписки/расписания на историю цен
-        self.exit_event = Event()  # Определяем событие выхода из потока
         self.dt_last_open = datetime.min  # Дата и время открытия последнего полученного бара
         self.last_bar_received = False  # Получен последний бар
         self.live_mode = False  # Режим получения бар. False = История, True = Новые бары
+        self.live_files = {}  # Открытые на запись новых бар файлы истории/колонок по полному имени
+        self.live_writer = None  # Запись новых бар в текстовый файл истории
+        self.live_partition = None  # Период бинарного файла истории, колонки которого открыты на запись
+        self.unflushed_bars = 0  # Кол-во новых бар, записанных в буфер, но еще не сброшенных на диск
+        self.base_bucket = self.base_emitted = None  # Дата и время открытия строящегося и последнего построенного из бар базового интервала бара в секундах
+        self.base_bars = {}  # Бары базового интервала строящегося бара по дате и времени открытия в секундах
 
     def setenvironment(self, env):
         """Добавление хранилища Алор в cerebro"""
         super(ALData, self).setenvironment(env)
         env.addstore(self.store)  # Добавление хранилища Алор в cerebro
+        self.store.datas.append(self)  # Регистрируем данные в хранилище для параллельной подготовки
 
     def start(self):
         super(ALData, self).start()
         self.put_notification(self.DELAYED)  # Отправляем уведомление об отправке исторических (не новых) бар
-        self.get_bars_from_file()  # Получаем бары из файла
-        self.get_bars_from_history()  # Получаем бары из истории
+        if self.warm_up_future:  # Если хранилище уже запустило подготовку данных
+            self.warm_up_future.result()  # то дожидаемся ее окончания. Если при подготовке была ошибка, то она будет здесь
+        else:  # Если подготовка данных не запускалась
+            self.warm_up()  # то подготавливаем данные
+        self.store.save_metadata()  # Сохраняем полученную информацию о тикере для следующего запуска
         if len(self.history_bars) > 0:  # Если был получен хотя бы 1 бар
             self.put_notification(self.CONNECTED)  # то отправляем уведомление о подключении и начале получения исторических бар
-        if self.p.live_bars:  # Если получаем историю и новые бары
+        if self.p.live_bars and not self.p.offline:  # Если получаем историю и новые бары
             if self.p.schedule:  # Если получаем новые бары по расписанию
                 self.guid = str(uuid4())  # guid расписания
-                Thread(target=self.stream_bars).start()  # Создаем и запускаем получение новых бар по расписанию в потоке
+                self.store.open_bar_queue(self.guid)  # Открываем очередь новых бар
+                self.store.add_schedule(self)  # Получаем новые бары по расписанию в общем планировщике хранилища
             else:  # Если получаем новые бары по подписке
                 # Ответ ALOR OpenAPI Support: Чтобы получать последний бар сессии на первом тике следующей сессии, нужно использовать скрытый параметр frequency в ms с очень большим значением (1_000_000_000)
                 # С 09:00 до 10:00 Алор перезапускает сервер, и подписка на последний бар предыдущей сессии по фьючерсам пропадает.
                 # В этом случае нужно брать данные не из подписки, а из расписания
                 seconds_from = self.get_seconds_from()  # Дата и время начала выборки
-                self.logger.debug(f'Запуск подписки на новые бары с {self.store.provider.utc_timestamp_to_msk_datetime(seconds_from).strftime(self.dt_format)}')
-                self.guid = self.store.provider.bars_get_and_subscribe(self.exchange, self.symbol, self.alor_timeframe, seconds_from, frequency=1_000_000_000)  # Подписываемся на бары, получаем guid подписки
-                self.logger.debug(f'Код подписки {self.guid}')
+                self.guid = str(uuid4())  # guid очереди новых бар. Подписка на сервере Алор общая для всех данных с такими же тикером и интервалом
+                self.store.open_bar_queue(self.guid)  # Открываем очередь новых бар до подписки. Подписка сразу отдает последние бары
+                self.base_bucket = self.base_emitted = None  # Строящегося и последнего построенного из бар базового интервала бара еще нет
+                self.base_bars = {}  # Бары базового интервала строящегося бара по дате и времени открытия в секундах
+                tf = str(self.tf_to_seconds(self.p.base_tf)) if self.is_base_tf_valid() else self.alor_timeframe  # Если бары строятся из бар базового интервала, то подписываемся на них
+                self.logger.debug(f'Запуск подписки {self.guid} на новые бары {tf} с {self.store.utc_timestamp_to_msk_datetime(seconds_from).strftime(self.dt_format)}')
+                self.store.subscribe_bars(self, tf, seconds_from)  # Подписываемся на бары
+
+    def warm_up(self) -> None:
+        """Подготовка данных: информация о тикере, бары из файла и истории
+        Может выполняться хранилищем в отдельном потоке параллельно с подготовкой других данных
+        """
+        self.get_symbol_metadata()  # Получаем информацию о тикере
+        if self.p.base_tf:  # Если бары строятся из файла истории другого временнОго интервала
+            self.get_bars_from_base_file()  # то дописываем в файл истории бары, построенные по новым барам файла с базовым интервалом
+        self.get_bars_from_file()  # Получаем бары из файла
+        if self.p.offline:  # Если работаем без подключения к Алор
+            if self.p.live_bars:  # и заданы новые бары
+                self.logger.warning('Без подключения к Алор новые бары не получаются. Бары только из файла истории')
+            return  # то бары из истории не получаем
+        self.get_bars_from_history()  # Получаем бары из истории
+
+    def get_symbol_metadata(self) -> None:
+        """Получение информации о тикере и имен файлов истории. Информация берется из кэша хранилища. Без подключения к Алор - независимо от срока актуальности"""
+        self.board, self.symbol = self.store.get_metadata('dataname_to_alor_board_symbol', self.p.dataname, offline=self.p.offline)  # По тикеру получаем код режима торгов и тикера
+        self.derivative = self.board == 'RFUD'  # Для деривативов не используем конвертацию цен и кол-ва
+        self.exchange = self.store.get_metadata('get_exchange', self.board, self.symbol, offline=self.p.offline)  # Биржа тикера. В Алор запросы выполняются по коду биржи и тикера
+        self.lotsize = self.store.get_metadata('get_symbol', self.exchange, self.symbol, offline=self.p.offline)['lotsize']  # Размер лота
+        # Перевод цены Алор в цену в рублях за штуку и лотов в штуки пропорционален значению. Коэффициенты получаем один раз, а не на каждый бар
+        self.price_ratio = 1.0 if self.derivative else self.store.get_metadata('alor_price_to_price', self.exchange, self.symbol, self.ratio_base, offline=self.p.offline) / self.ratio_base  # Для деривативов цена без изменения
+        self.size_ratio = 1.0 if self.derivative else self.store.get_metadata('lots_to_size', self.exchange, self.symbol, self.ratio_base, offline=self.p.offline) / self.ratio_base  # Для деривативов кол-во лотов без изменения
+        self.portfolio = self.store.get_metadata('get_account', self.board, self.p.account_id, offline=self.p.offline)['portfolio']  # Портфель тикера
+        self.set_file_names(self.tf)  # Имена файлов истории
+        self.logger = logging.getLogger(f'ALData.{self.file}')  # Будем вести лог
+
+    def set_file_names(self, tf) -> None:
+        """Имена файлов истории тикера по временному интервалу. Чтение и запись файлов истории выполняются по этим именам"""
+        self.file = f'{self.board}.{self.symbol}_{tf}'  # Имя файла истории
+        self.file_name = f'{self.datapath}{self.file}.txt'  # Полное имя файла истории
+        self.index_file_name = f'{self.datapath}{self.file}.idx'  # Полное имя файла индекса текстового файла истории
+        self.bin_path = os.path.join(f'{self.datapath}{self.file}', '')  # Папка бинарного файла истории
 
     def _load(self):
         """Загрузка бара из истории или нового бара"""
         if len(self.history_bars) > 0:  # Если есть исторические данные
-            bar = self.history_bars.pop(0)  # Берем и удаляем первый бар из хранилища. С ним будем работать
-        elif not self.p.live_bars:  # Если получаем только историю (self.history_bars) и исторических данных нет / все исторические данные получены
+            bar = self.history_bars.popleft()  # Берем и удаляем первый бар из хранилища. С ним будем работать
+        elif not self.p.live_bars or self.p.offline:  # Если получаем только историю (self.history_bars) или работаем без подключения к Алор, и исторических данных нет / все исторические данные получены
             self.put_notification(self.DISCONNECTED)  # Отправляем уведомление об окончании получения исторических бар
             self.logger.debug('Бары из файла/истории отправлены в ТС. Новые бары получать не нужно. Выход')
             return False  # Больше сюда заходить не будем
-        else:  # Если получаем историю и новые бары (self.store.new_bars)
-            new_bars = [new_bar for new_bar in self.store.new_bars if new_bar['guid'] == self.guid]  # Получаем новые бары из хранилища по guid
-            if len(new_bars) == 0:  # Если новый бар еще не появился
-                # self.logger.debug(f'Новых бар нет. Ожидание {self.sleep_time_sec} с')  # Для отладки. Грузит процессор
-                sleep(self.sleep_time_sec)  # Ждем для снижения нагрузки/энергопотребления процессора
+        else:  # Если получаем историю и новые бары (self.store.new_bars[self.guid])
+            new_bars = self.store.new_bars[self.guid]  # Очередь новых бар подписки/расписания
+            if len(new_bars) == 0 and not new_bars.wait(self.sleep_time_sec):  # Если новый бар еще не появился и не пришел за время ожидания
+                # self.logger.debug(f'Новых бар нет за {self.sleep_time_sec} с')  # Для отладки. Грузит процессор
                 return None  # то нового бара нет, будем заходить еще
             self.last_bar_received = len(new_bars) == 1  # Если в хранилище остался 1 бар, то мы будем получать последний возможный бар
             if self.last_bar_received:  # Получаем последний возможный бар
                 self.logger.debug('Получение последнего возможного на данный момент бара')
-            bar = new_bars[0]  # Берем первый бар из хранилища новых бар. С ним будем работать
-            self.store.new_bars.remove(bar)  # Удаляем этот бар из хранилища новых бар
-            bar = bar['data']  # Данные бара
+            bar, put_time = new_bars.popleft()  # Берем и удаляем первый бар из очереди новых бар. С ним будем работать
+            self.store.metrics.observe('alor_bar_delivery_seconds', perf_counter() - put_time)  # Время от постановки бара в очередь до выдачи
             # self.logger.debug(f'Новый бар из подписки {bar}')  # Для отладки
             if not self.is_bar_valid(bar):  # Если бар не соответствует всем условиям выборки
                 return None  # то пропускаем бар, будем заходить еще
-            self.logger.debug(f'Сохранение нового бара с {bar["datetime"].strftime(self.dt_format)} в файл')
             self.save_bar_to_file(bar)  # Сохраняем бар в конец файла
             if self.last_bar_received and not self.live_mode:  # Если получили последний бар и еще не находимся в режиме получения новых бар (LIVE)
                 self.put_notification(self.LIVE)  # Отправляем уведомление о получении новых бар
@@ -115,149 +175,722 @@ class ALData(with_metaclass(MetaALData, AbstractDataBase)):
                 self.put_notification(self.DELAYED)  # Отправляем уведомление об отправке исторических (не новых) бар
                 self.live_mode = False  # Переходим в режим получения истории
         # Все проверки пройдены. Записываем полученный исторический/новый бар
-        self.lines.datetime[0] = date2num(bar['datetime'])  # Переводим в формат хранения даты/времени в BackTrader
-        self.lines.open[0] = bar['open'] if self.derivative else self.store.provider.alor_price_to_price(self.exchange, self.symbol, bar['open'])  # Для деривативов
-        self.lines.high[0] = bar['high'] if self.derivative else self.store.provider.alor_price_to_price(self.exchange, self.symbol, bar['high'])  # цена без изменения
-        self.lines.low[0] = bar['low'] if self.derivative else self.store.provider.alor_price_to_price(self.exchange, self.symbol, bar['low'])  # Для остальных
-        self.lines.close[0] = bar['close'] if self.derivative else self.store.provider.alor_price_to_price(self.exchange, self.symbol, bar['close'])  # цена в рублях за штуку
-        self.lines.volume[0] = int(bar['volume']) if self.derivative else self.store.provider.lots_to_size(self.exchange, self.symbol, int(bar['volume']))  # Для деривативов кол-во лотов. Для остальных кол-во штук
+        self.lines.datetime[0] = self.seconds_to_num(bar.seconds)  # Переводим в формат хранения даты/времени в BackTrader. Дата и время бара не создаются
+        self.lines.open[0], self.lines.high[0], self.lines.low[0], self.lines.close[0], self.lines.volume[0] = self.bar_to_lines(bar)  # Цены и объем бара
         self.lines.openinterest[0] = 0  # Открытый интерес в Алор не учитывается
         return True  # Будем заходить сюда еще
 
+    def preload(self):
+        """Загрузка всех исторических бар в линии за один проход (preload/runonce)
+        Если получаем только историю, то бары не проходят по одному через _load, а сразу добавляются в буферы линий
+        """
+        if self.islive() or self._filters or self._ffilters or self._tzinput or not isinstance(self.lines.datetime.array, array):  # Если есть новые бары, фильтры, перевод временнОй зоны или буферы ограничены (exactbars)
+            super(ALData, self).preload()  # то загружаем бары по одному
+            return  # Дальше не продолжаем
+        seconds, opens, highs, lows, closes, volumes = self.history_bars.get_columns()  # Колонки бар
+        self.history_bars = Bars()  # Бары будут в линиях. Из хранилища их удаляем
+        nums = array('d', map(self.seconds_to_num, seconds))  # Дата и время в формате BackTrader
+        i_from, i_to = bisect_left(nums, self.fromdate), bisect_right(nums, self.todate)  # Бары из диапазона BackTrader. Без диапазона границы бесконечные
+        self.lines.datetime.array.extend(nums[i_from:i_to])  # Добавляем колонку даты и времени в буфер линии одной операцией
+        for line, column in zip((self.lines.open, self.lines.high, self.lines.low, self.lines.close), (opens, highs, lows, closes)):  # Пробегаемся по всем колонкам цен
+            line.array.extend(self.alor_prices_to_prices(column[i_from:i_to]))  # Переводим колонку цен и добавляем ее в буфер линии одной операцией
+        self.lines.volume.array.extend(self.lots_to_sizes(volumes[i_from:i_to]))  # Переводим колонку объемов и добавляем ее в буфер линии одной операцией
+        self.lines.openinterest.array.extend(array('d', (0.0,)) * (i_to - i_from))  # Открытый интерес в Алор не учитывается
+        self.put_notification(self.DISCONNECTED)  # Отправляем уведомление об окончании получения исторических бар
+        self.logger.debug(f'Бары из файла/истории загружены в ТС: {i_to - i_from}. Новые бары получать не нужно')
+        self._last()  # Даем фильтрам последнюю возможность выдать бары
+        self.home()  # Переходим в начало буферов линий
+
     def stop(self):
         super(ALData, self).stop()
-        if self.p.live_bars:  # Если была подписка/расписание
+        self.warm_up_future = None  # При следующем запуске данные нужно будет подготовить заново
+        self.store.datas = [data for data in self.store.datas if data is not self]  # Удаляем данные из хранилища. Данные BackTrader сравниваем по ссылке, т.к. == у них переопределен
+        self.close_live_files()  # Сбрасываем на диск и закрываем файлы истории новых бар
+        if self.p.live_bars and not self.p.offline:  # Если была подписка/расписание
             if self.p.schedule:  # Если получаем новые бары по расписанию
-                self.exit_event.set()  # то отменяем расписание
+                self.store.remove_schedule(self)  # то отменяем расписание
             else:  # Если получаем новые бары по подписке
                 self.logger.info(f'Отмена подписки {self.guid} на новые бары')
-                self.store.provider.unsubscribe(self.guid)  # то отменяем подписку
+                self.store.unsubscribe_bars(self)  # то отменяем подписку. На сервере Алор она отменится, если больше не нужна другим данным
+            self.store.close_bar_queue(self.guid)  # Закрываем очередь новых бар
             self.put_notification(self.DISCONNECTED)  # Отправляем уведомление об окончании получения новых бар
         self.store.DataCls = None  # Удаляем класс данных в хранилище
 
     # Получение/сохранение бар
 
     def get_bars_from_file(self) -> None:
-        """Получение бар из файла"""
+        """Получение бар из файла
+        Читаются только бары из диапазона fromdate - todate. Дата и время открытия последнего бара берется с конца файла без чтения остальных бар
+        """
+        seconds_from = self.datetime_to_seconds(self.p.fromdate) if self.p.fromdate else None  # Дата и время начала диапазона в секундах
+        seconds_to = self.datetime_to_seconds(self.p.todate) if self.p.todate else None  # Дата и время окончания диапазона в секундах
+        if self.p.binary_file:  # Если история хранится в бинарном файле
+            if not os.path.isdir(self.bin_path) and os.path.isfile(self.file_name):  # Если бинарного файла еще нет, но есть текстовый
+                self.txt_to_bin_file()  # то однократно переводим текстовый файл в бинарный
+            bars = self.read_bin_file(seconds_from, seconds_to)  # Бары из бинарного файла
+            dt_last = self.get_bin_last_datetime()  # Дата и время открытия последнего бара бинарного файла
+        else:  # Если история хранится в текстовом файле
+            bars = Bars(self.read_txt_file(seconds_from, seconds_to))  # Бары из текстового файла
+            dt_last = self.get_txt_last_datetime()  # Дата и время открытия последнего бара текстового файла
+        self.history_bars.extend(self.filter_bars(bars))  # Добавляем бары, соответствующие всем условиям выборки
+        if dt_last and dt_last > self.dt_last_open:  # Если в файле есть бары после диапазона
+            self.dt_last_open = dt_last  # то следующие бары будем получать после последнего бара файла
+        if len(self.history_bars) > 0:  # Если были получены бары из файла
+            self.logger.debug(f'Получено бар из файла: {len(self.history_bars)} с {self.history_bars[0].datetime.strftime(self.dt_format)} по {self.history_bars[-1].datetime.strftime(self.dt_format)}')
+        else:  # Бары из файла не получены
+            self.logger.debug('Из файла новых бар не получено')
+
+    def get_bars_from_base_file(self) -> None:
+        """Построение бар из файла истории с базовым временнЫм интервалом base_tf и запись их в файл истории
+        Бары выравниваются по началу дня, как бары Алор. Записываются только завершенные бары внутри торговой сессии. Остальные бары получаем из истории
+        """
+        if not self.is_base_tf_valid():  # Если бары нельзя построить из бар базового интервала
+            self.logger.warning(f'Бары {self.tf} из бар {self.p.base_tf} не строятся. Бары будут получены из истории')
+            return  # то выходим, дальше не продолжаем
+        base_period = self.tf_to_seconds(self.p.base_tf)  # Длительность бара базового интервала в секундах
+        period = self.tf_to_seconds(self.tf)  # Длительность бара в секундах
+        for data in self.store.datas:  # Пробегаемся по всем данным хранилища
+            if data is not self and data.p.dataname == self.p.dataname and data.tf == self.p.base_tf and data.warm_up_future:  # Если данные базового интервала подготавливаются параллельно
+                data.warm_up_future.result()  # то дожидаемся, пока они допишут свой файл истории
+        dt_last = self.get_bin_last_datetime() if self.p.binary_file else self.get_txt_last_datetime()  # Дата и время открытия последнего бара файла истории
+        seconds_from = self.datetime_to_seconds(dt_last) + period if dt_last else None  # Строим бары после последнего бара файла
+        self.set_file_names(self.p.base_tf)  # Читаем файл истории базового интервала
+        try:
+            base_seconds_from = seconds_from - period if seconds_from else None  # Читаем и последний построенный бар. По нему видно, что следующий бар начинается с начала
+            base_bars = self.read_bin_file(base_seconds_from) if self.p.binary_file else self.read_txt_file(base_seconds_from)  # Новые бары базового интервала
+            bars, partial_seconds = self.resample_bars(base_bars or (), period, base_period)  # Строим бары
+        finally:
+            self.set_file_names(self.tf)  # Возвращаемся к своему файлу истории
+        bars = [bar for bar in bars if seconds_from is None or bar.seconds >= seconds_from]  # Бары после последнего бара файла
+        if partial_seconds is not None and (seconds_from is None or partial_seconds >= seconds_from):  # Если первый бар неполный, и его нет в файле истории
+            bar = self.get_history_bar(partial_seconds) if not self.p.offline else None  # то получаем его из истории. Иначе загрузка истории продолжится после него, и бара в файле не будет
+            if bar:  # Если бар получен
+                bars.insert(0, bar)  # то он будет первым
+            else:  # Если бар не получен
+                self.logger.warning(f'Бар {self.seconds_to_datetime(partial_seconds).strftime(self.dt_format)} не построен из {self.p.base_tf} и не получен из истории')
+        self.save_bars_to_file(bars)  # Записываем построенные бары в конец файла истории
+        if len(bars) > 0:  # Если бары построены
+            self.logger.debug(f'Построено бар из {self.p.base_tf}: {len(bars)} с {bars[0].datetime.strftime(self.dt_format)} по {bars[-1].datetime.strftime(self.dt_format)}')
+
+    def is_base_tf_valid(self) -> bool:
+        """Можно ли строить бары из внутридневных бар базового интервала base_tf"""
+        if not self.p.base_tf or not self.p.base_tf.startswith('M'):  # Если базовый интервал не задан или не минутный
+            return False
+        base_period = self.tf_to_seconds(self.p.base_tf)  # Длительность бара базового интервала в секундах
+        period = self.tf_to_seconds(self.tf)  # Длительность бара в секундах
+        return bool(base_period and period and period > base_period and period % base_period == 0)  # Бар должен состоять из целого числа бар базового интервала
+
+    def on_new_bar(self, bar) -> None:
+        """Новый бар из подписки хранилища. Вызывается хранилищем для всех данных подписки
+
+        :param Bar bar: Бар подписки. Один и тот же для всех данных подписки, поэтому не изменяется
+        """
+        if self.is_base_tf_valid():  # Если бары строятся из бар базового интервала
+            self.on_base_bar(bar)  # то строим бар
+        else:  # Если бары подписки нужного интервала
+            self.store.put_new_bar(self.guid, bar)  # то ставим бар в очередь новых бар
+
+    def on_base_bar(self, base_bar) -> None:
+        """Построение нового бара из бара подписки базового интервала. Вызывается хранилищем
+        Бар ставится в очередь новых бар, когда пришел бар базового интервала следующего бара или закрылся последний бар базового интервала
+
+        :param Bar base_bar: Бар базового интервала. Несформированный бар может приходить несколько раз
+        """
+        base_period = self.tf_to_seconds(self.p.base_tf)  # Длительность бара базового интервала в секундах
+        period = self.tf_to_seconds(self.tf)  # Длительность бара в секундах
+        base_seconds = base_bar.seconds  # Дата и время открытия бара базового интервала в секундах
+        seconds = self.get_bucket_seconds(base_seconds, period)  # Дата и время открытия бара, в который входит бар базового интервала. Бар вне сессии отбросит is_bar_valid
+        bucket_close = seconds + period  # Дата и время закрытия бара в секундах
+        if self.base_emitted is not None and seconds <= self.base_emitted or self.base_bucket is not None and seconds < self.base_bucket:  # Если бар уже построен
+            return  # то бар базового интервала пропускаем
+        if seconds != self.base_bucket:  # Если начался новый бар
+            self.put_base_bar()  # то ставим в очередь предыдущий бар
+            self.base_bucket = seconds  # Начинаем строить новый бар
+        self.base_bars[base_seconds] = base_bar  # Несформированный бар базового интервала заменяется пришедшим позже
+        if base_seconds + base_period >= bucket_close:  # Если пришел последний бар базового интервала
+            seconds_close = self.store.msk_datetime_to_utc_timestamp(self.seconds_to_datetime(bucket_close))  # Дата и время закрытия бара в секундах UTC
+            if self.store.get_alor_timestamp_now() >= seconds_close:  # Если бар закрылся на бирже
+                self.put_base_bar()  # то ставим его в очередь
+
+    def put_base_bar(self) -> None:
+        """Постановка построенного бара в очередь новых бар"""
+        if not self.base_bars:  # Если бар не строится
+            return  # то выходим, дальше не продолжаем
+        base_bars = [self.base_bars[base_seconds] for base_seconds in sorted(self.base_bars)]  # Бары базового интервала по возрастанию
+        bar = Bar(self.base_bucket, base_bars[0].open, max(base_bar.high for base_bar in base_bars), min(base_bar.low for base_bar in base_bars), base_bars[-1].close,
+                  sum(base_bar.volume for base_bar in base_bars))  # Бар из бар базового интервала
+        self.base_emitted = self.base_bucket  # Бар построен
+        self.base_bars = {}  # Начинаем строить новый бар
+        self.store.put_new_bar(self.guid, bar)  # Ставим бар в очередь новых бар
+
+    def resample_bars(self, base_bars, period, base_period) -> tuple:
+        """Построение бар из бар меньшего временнОго интервала
+        Бары выравниваются по началу дня, как бары Алор. Бары вне торговой сессии sessionstart - sessionend не строятся, как в is_bar_valid
+
+        :param base_bars: Бары базового интервала по возрастанию даты и времени открытия
+        :param int period: Длительность бара в секундах. Для дневного интервала 86400
+        :param int base_period: Длительность бара базового интервала в секундах
+        :return: Завершенные бары и дата и время открытия первого бара, если бары базового интервала начинаются с его середины. Такой бар не строится
+        """
+        bars = []  # Построенные бары
+        bar = None  # Строящийся бар
+        last_seconds = None  # Дата и время открытия последнего бара базового интервала в секундах
+        partial_seconds = None  # Дата и время открытия первого бара, если бары базового интервала начинаются с его середины
+        for base_bar in base_bars:  # Пробегаемся по всем барам базового интервала
+            last_seconds = base_bar.seconds  # Дата и время открытия бара базового интервала в секундах
+            seconds = self.get_bucket_seconds(last_seconds, period)  # Дата и время открытия бара, в который входит бар базового интервала
+            if bar and seconds == bar.seconds:  # Если бар базового интервала входит в строящийся бар
+                bar.high = max(bar.high, base_bar.high)
+                bar.low = min(bar.low, base_bar.low)
+                bar.close = base_bar.close
+                bar.volume += base_bar.volume
+                continue
+            if bar and bar.seconds != partial_seconds:  # Если начался новый бар, то предыдущий бар завершен. Неполный первый бар пропускаем
+                bars.append(bar)
+            elif not bar and last_seconds != seconds and self.is_bucket_in_session(seconds, period):  # Если первый бар базового интервала не с начала бара
+                partial_seconds = seconds  # то первый бар неполный. Его нужно получить из истории
+            bar = Bar(seconds, base_bar.open, base_bar.high, base_bar.low, base_bar.close, base_bar.volume)  # Новый бар
+        if bar and bar.seconds != partial_seconds and last_seconds + base_period >= bar.seconds + period:  # Если последний бар базового интервала закрывает последний бар
+            bars.append(bar)  # то последний бар тоже завершен
+        return [bar for bar in bars if self.is_bucket_in_session(bar.seconds, period)], partial_seconds
+
+    @staticmethod
+    def get_bucket_seconds(base_seconds, period) -> int:
+        """Дата и время открытия бара, в который входит бар базового интервала. Бары выравниваются по началу дня, как бары Алор, и не переходят через границу дня
+
+        :param int base_seconds: Дата и время открытия бара базового интервала в секундах
+        :param int period: Длительность бара в секундах. Для дневного интервала 86400
+        """
+        day_seconds = base_seconds - base_seconds % 86400  # Начало дня в секундах
+        return day_seconds + (base_seconds - day_seconds) // period * period
+
+    def is_bucket_in_session(self, seconds, period) -> bool:
+        """Входит ли бар в торговую сессию sessionstart - sessionend. Как в is_bar_valid: открытие не раньше начала, закрытие не позже окончания сессии
+
+        :param int seconds: Дата и время открытия бара в секундах
+        :param int period: Длительность бара в секундах
+        """
+        if self.p.sessionstart != time.min and seconds % 86400 * 1_000_000 < self.time_to_microseconds(self.p.sessionstart):  # Если открытие бара до начала сессии
+            return False
+        if self.p.sessionend != time(23, 59, 59, 999990) and (seconds + period) % 86400 * 1_000_000 > self.time_to_microseconds(self.p.sessionend):  # Если закрытие бара после окончания сессии
+            return False
+        return True
+
+    def get_history_bar(self, seconds) -> Union[Bar, None]:
+        """Бар из истории Алор по дате и времени открытия. Для бара, который нельзя построить из бар базового интервала
+
+        :param int seconds: Дата и время открытия бара в секундах
+        :return: Бар или None, если бар не получен
+        """
+        timestamp = self.store.msk_datetime_to_utc_timestamp(self.seconds_to_datetime(seconds)) if self.intraday else seconds  # Для дневок и выше время открытия бара в GMT
+        response = self.store.provider.get_history(self.exchange, self.symbol, self.alor_timeframe, timestamp, timestamp)  # Запрашиваем один бар
+        for history_bar in (response or {}).get('history', []):  # Пробегаемся по всем полученным барам
+            if self.store.get_bar_open_seconds(history_bar['time'], self.intraday) == seconds:  # Если нашли нужный бар
+                return Bar(seconds, history_bar['open'], history_bar['high'], history_bar['low'], history_bar['close'], int(history_bar['volume']))  # то возвращаем его
+        return None  # Бар не получен
+
+    def read_txt_file(self, seconds_from=None, seconds_to=None):
+        """Бары из текстового файла
+
+        :param int seconds_from: Дата и время открытия первого бара в секундах. Чтение начинается с ближайшей записи индекса
+        :param int seconds_to: Дата и время открытия последнего бара в секундах
+        """
         if not os.path.isfile(self.file_name):  # Если файл не существует
             return  # то выходим, дальше не продолжаем
         self.logger.debug(f'Получение бар из файла {self.file_name}')
-        with open(self.file_name) as file:  # Открываем файл на последовательное чтение
-            reader = csv.reader(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
-            next(reader, None)  # Пропускаем первую строку с заголовками
+        offset = 0  # Смещение в файле, с которого начинаем чтение
+        if seconds_from is not None:  # Если задано начало диапазона
+            index = self.get_txt_index()  # Индекс текстового файла
+            i = bisect_right(index[0::2], seconds_from) - 1  # Последняя запись индекса до начала диапазона
+            if i >= 0:  # Если такая запись есть
+                offset = index[2 * i + 1]  # то начинаем чтение с нее
+        with open(self.file_name, 'rb') as file:  # Открываем файл на последовательное чтение
+            file.seek(offset)  # Переходим к началу чтения
+            reader = csv.reader(io.TextIOWrapper(file, newline=''), delimiter=self.delimiter)  # Данные в строке разделены табуляцией
+            if offset == 0:  # Если читаем с начала файла
+                next(reader, None)  # то пропускаем первую строку с заголовками
             for csv_row in reader:  # Последовательно получаем все строки файла
-                bar = dict(datetime=datetime.strptime(csv_row[0], self.dt_format),
-                           open=float(csv_row[1]), high=float(csv_row[2]), low=float(csv_row[3]), close=float(csv_row[4]),
-                           volume=int(csv_row[5]))  # Бар из файла
-                if self.is_bar_valid(bar):  # Если исторический бар соответствует всем условиям выборки
-                    self.history_bars.append(bar)  # то добавляем бар
-        if len(self.history_bars) > 0:  # Если были получены бары из файла
-            self.logger.debug(f'Получено бар из файла: {len(self.history_bars)} с {self.history_bars[0]["datetime"].strftime(self.dt_format)} по {self.history_bars[-1]["datetime"].strftime(self.dt_format)}')
-        else:  # Бары из файла не получены
-            self.logger.debug('Из файла новых бар не получено')
+                seconds = self.datetime_to_seconds(datetime.strptime(csv_row[0], self.dt_format))  # Дата и время открытия бара в секундах
+                if seconds_from is not None and seconds < seconds_from:  # Если бар до начала диапазона
+                    continue  # то пропускаем его
+                if seconds_to is not None and seconds > seconds_to:  # Если бар после окончания диапазона
+                    return  # то дальше бары не читаем
+                yield Bar(seconds, float(csv_row[1]), float(csv_row[2]), float(csv_row[3]), float(csv_row[4]), int(csv_row[5]))  # Бар из файла
+
+    def get_txt_index(self) -> array:
+        """Индекс текстового файла истории. Пары значений: дата и время открытия бара в секундах, смещение строки бара в файле
+        Запись в индекс делается для каждой index_step строки. Индекс дополняется строками, дописанными в файл после прошлого запуска
+        """
+        index = array('q')  # Индекс
+        if os.path.isfile(self.index_file_name):  # Если индекс уже строился
+            with open(self.index_file_name, 'rb') as file:  # то открываем файл индекса
+                index.frombytes(file.read())  # и читаем его
+        with open(self.file_name, 'rb') as file:  # Открываем текстовый файл истории на чтение
+            if len(index) > 0:  # Если индекс есть
+                file.seek(index[-1])  # то переходим к строке последней записи индекса
+                try:  # Файл мог быть перезаписан или обрезан
+                    index_valid = self.txt_line_to_seconds(file.readline()) == index[-2]  # В строке должен быть бар последней записи индекса
+                except ValueError:  # Если в строке нет бара
+                    index_valid = False  # то индекс не соответствует файлу
+                if not index_valid:  # Если индекс не соответствует файлу
+                    index = array('q')  # то строим индекс заново
+            if len(index) == 0:  # Если индекс строим с начала
+                file.seek(0)  # то читаем файл с начала
+                file.readline()  # Пропускаем первую строку с заголовками
+                rows = self.index_step  # Первая строка с баром попадает в индекс
+                rebuild = True  # Файл индекса будем перезаписывать
+            else:  # Если дополняем индекс
+                rows = 1  # Строка последней записи индекса уже прочитана
+                rebuild = False  # Файл индекса будем дописывать
+            offset = file.tell()  # Смещение следующей строки
+            new_index = array('q')  # Новые записи индекса
+            for line in file:  # Пробегаемся по оставшимся строкам
+                if not line.endswith(b'\n'):  # Если строка записана не полностью
+                    break  # то дальше не индексируем
+                if rows == self.index_step:  # Если строка попадает в индекс
+                    new_index.extend((self.txt_line_to_seconds(line), offset))  # то добавляем запись в индекс
+                    rows = 0  # Начинаем отсчет строк заново
+                rows += 1  # Увеличиваем кол-во строк после последней записи индекса
+                offset += len(line)  # Смещение следующей строки
+        if rebuild or len(new_index) > 0:  # Если индекс изменился
+            with open(self.index_file_name, 'wb' if rebuild else 'ab') as file:  # то перезаписываем или дописываем файл индекса
+                new_index.tofile(file)
+        index.extend(new_index)  # Добавляем новые записи в индекс
+        return index
+
+    def txt_line_to_seconds(self, line) -> int:
+        """Дата и время открытия бара в секундах из строки текстового файла истории"""
+        return self.datetime_to_seconds(datetime.strptime(line.split(self.delimiter.encode(), 1)[0].decode(), self.dt_format))
+
+    def get_txt_last_datetime(self) -> Union[datetime, None]:
+        """Дата и время открытия последнего бара текстового файла истории. Читается только конец файла"""
+        if not os.path.isfile(self.file_name):  # Если файл не существует
+            return None  # то последнего бара нет
+        with open(self.file_name, 'rb') as file:  # Открываем файл на чтение
+            size = file.seek(0, os.SEEK_END)  # Размер файла
+            file.seek(max(0, size - 1024))  # Конец файла с запасом на несколько строк
+            lines = file.read().splitlines()  # Строки конца файла
+        for line in reversed(lines):  # Пробегаемся по строкам с конца
+            try:  # Последняя строка может быть записана не полностью, первая строка может быть заголовком или обрезанной
+                return datetime.strptime(line.split(self.delimiter.encode(), 1)[0].decode(), self.dt_format)
+            except (ValueError, UnicodeDecodeError):  # Если дату и время из строки получить не удалось
+                continue  # то переходим к предыдущей строке
+        return None  # Бар в файле нет
+
+    def read_bin_file(self, seconds_from=None, seconds_to=None) -> Bars:
+        """Бары из бинарного файла. Колонки каждого периода отображаются в память и копируются в колонки бар целиком без создания бар
+
+        :param int seconds_from: Дата и время открытия первого бара в секундах. Периоды до начала диапазона не читаются
+        :param int seconds_to: Дата и время открытия последнего бара в секундах. Периоды после окончания диапазона не читаются
+        """
+        bars = Bars()  # Бары из бинарного файла
+        if not os.path.isdir(self.bin_path):  # Если бинарного файла нет
+            return bars  # то бар нет
+        self.logger.debug(f'Получение бар из бинарного файла {self.bin_path}')
+        partition_from = self.seconds_to_datetime(seconds_from).strftime(self.bin_partition) if seconds_from is not None else None  # Период начала диапазона
+        partition_to = self.seconds_to_datetime(seconds_to).strftime(self.bin_partition) if seconds_to is not None else None  # Период окончания диапазона
+        for partition in self.get_bin_partitions():  # Пробегаемся по всем периодам по возрастанию
+            if partition_from and partition < partition_from:  # Если период до начала диапазона
+                continue  # то его не читаем
+            if partition_to and partition > partition_to:  # Если период после окончания диапазона
+                break  # то дальше периоды не читаем
+            columns = self.read_bin_partition(partition)  # Колонки периода
+            i_from = bisect_left(columns[0], seconds_from) if seconds_from is not None else 0  # Первый бар периода из диапазона
+            i_to = bisect_right(columns[0], seconds_to) if seconds_to is not None else len(columns[0])  # Бар периода после диапазона
+            bars.extend_columns(*(column[i_from:i_to] for column in columns))  # Добавляем бары периода из диапазона
+        return bars
+
+    def get_bin_last_datetime(self) -> Union[datetime, None]:
+        """Дата и время открытия последнего бара бинарного файла истории. Читается только последний период"""
+        for partition in reversed(self.get_bin_partitions()):  # Пробегаемся по периодам с конца
+            dts = self.read_bin_partition(partition)[0]  # Колонка даты и времени открытия бар периода
+            if len(dts) > 0:  # Если в периоде есть бары
+                return self.seconds_to_datetime(dts[-1])  # то возвращаем дату и время открытия последнего бара
+        return None  # Бар в файле нет
+
+    def get_bin_partitions(self) -> list:
+        """Периоды бинарного файла по возрастанию"""
+        if not os.path.isdir(self.bin_path):  # Если бинарного файла нет
+            return []  # то периодов нет
+        return sorted({file_name.split('.')[0] for file_name in os.listdir(self.bin_path) if not file_name.startswith('.')})  # Имена периодов по формату bin_partition сортируются по времени
+
+    def read_bin_partition(self, partition) -> list:
+        """Колонки периода бинарного файла, отображенные в память"""
+        columns = []  # Колонки периода
+        for column, typecode in self.bin_columns:  # Пробегаемся по всем колонкам
+            with open(f'{self.bin_path}{partition}.{column}', 'rb') as file:  # Открываем файл колонки на чтение
+                if os.fstat(file.fileno()).st_size == 0:  # Если колонка пустая
+                    columns.append(memoryview(array(typecode)))  # то отображать в память нечего
+                    continue  # переходим к следующей колонке
+                columns.append(memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode))  # Отображение остается открытым, пока на него есть ссылки
+        length = min(len(column) for column in columns)  # Если запись периода была прервана, то берем только полностью записанные бары
+        return [column[:length] for column in columns]
 
     def get_bars_from_history(self) -> None:
-        """Получение бар из истории"""
+        """Получение бар из истории
+        Части загружаются параллельно в history_workers потоков и сохраняются в файл по порядку. Пока сохраняется первая часть, следующие уже загружаются,
+        поэтому в памяти одновременно до history_workers ответов, всего не больше history_chunk_bars бар
+        """
         file_history_bars_len = len(self.history_bars)  # Кол-во полученных бар из файла для лога
         seconds_from = self.get_seconds_from()  # Дата и время начала выборки в секундах
-        seconds_to = self.store.provider.msk_datetime_to_utc_timestamp(self.p.todate) if self.p.todate else 32536799999  # Дата и время окончания выборки в секундах
-        self.logger.debug(f'Получение бар из истории с {self.store.provider.utc_timestamp_to_msk_datetime(seconds_from).strftime(self.dt_format)} по {self.store.provider.utc_timestamp_to_msk_datetime(seconds_to).strftime(self.dt_format)}')
-        response = self.store.provider.get_history(self.exchange, self.symbol, self.alor_timeframe, seconds_from, seconds_to)  # Получаем бары из Алор
+        seconds_to = self.store.msk_datetime_to_utc_timestamp(self.p.todate) if self.p.todate else 32536799999  # Дата и время окончания выборки в секундах
+        chunk_sec = self.get_history_chunk_seconds()  # Размер части истории в секундах
+        seconds_from = self.get_history_start(seconds_from, seconds_to, chunk_sec)  # Пропускаем пустой диапазон до первого бара истории
+        chunks = self.get_history_chunks(seconds_from, seconds_to, chunk_sec)  # Части истории
+        self.logger.debug(f'Получение бар из истории с {self.store.utc_timestamp_to_msk_datetime(seconds_from).strftime(self.dt_format)} по {self.store.utc_timestamp_to_msk_datetime(seconds_to).strftime(self.dt_format)} частями: {len(chunks)}')
+        with ThreadPoolExecutor(max_workers=self.history_workers, thread_name_prefix=f'ALDataHistory.{self.file}') as pool:  # Пул потоков загрузки частей истории
+            requests = deque()  # Запросы частей истории по порядку
+            saved = True  # Все полученные части сохранены
+            for chunk_from, chunk_to in chunks:  # Пробегаемся по всем частям
+                requests.append(pool.submit(self.store.provider.get_history, self.exchange, self.symbol, self.alor_timeframe, chunk_from, chunk_to))  # Ставим запрос части в очередь пула
+                if len(requests) >= self.history_workers:  # Если одновременно загружается максимум частей
+                    saved = self.save_history_chunk(requests.popleft().result())  # то дожидаемся первой части и сохраняем ее. В памяти не больше history_workers частей
+                    if not saved:  # Если часть не получена
+                        break  # то следующие части не запрашиваем
+            while saved and requests:  # Пока есть запрошенные части
+                saved = self.save_history_chunk(requests.popleft().result())  # Дожидаемся части и сохраняем ее
+            for request in requests:  # Если часть не получена, то более поздние части не сохраняем. Следующая загрузка продолжится с последней сохраненной части
+                request.cancel()  # Отменяем еще не начатые запросы
+        if len(self.history_bars) - file_history_bars_len > 0:  # Если получены бары из истории
+            self.logger.debug(f'Получено бар из истории: {len(self.history_bars) - file_history_bars_len} с {self.history_bars[file_history_bars_len].datetime.strftime(self.dt_format)} по {self.history_bars[-1].datetime.strftime(self.dt_format)}')
+        else:  # Бары из истории не получены
+            self.logger.debug('Из истории новых бар не получено')
+
+    def get_history_chunk_seconds(self) -> int:
+        """Размер части истории в секундах. В часть попадает не больше history_chunk_bars // history_workers бар"""
+        bar_seconds = self.get_bar_close_offset() or 28 * 86400  # Бары открываются не чаще, чем через длительность бара. Для месяцев и лет берем самый короткий месяц
+        return max(1, self.history_chunk_bars // self.history_workers) * bar_seconds
+
+    def get_history_start(self, seconds_from, seconds_to, chunk_sec) -> int:
+        """Дата и время первого бара истории, чтобы не запрашивать пустые части при загрузке с начала
+        Если Алор вернул время следующего бара (next), то берем его. Иначе с конца ищем непустую часть (тикер мог перестать торговаться),
+        а от нее двоичным поиском первую непустую часть. Считаем, что перерывов в торгах длиннее части нет
+
+        :param int seconds_from: Дата и время начала выборки в секундах
+        :param int seconds_to: Дата и время окончания выборки в секундах
+        :param int chunk_sec: Размер части истории в секундах
+        :return: Дата и время начала загрузки в секундах
+        """
+        seconds_end = min(seconds_to, int(datetime.now(UTC).timestamp()))  # Окончание поиска. Бар из будущего нет
+        if seconds_from + chunk_sec > seconds_end:  # Если история загружается одной частью
+            return seconds_from  # то искать нечего
+        response = self.store.provider.get_history(self.exchange, self.symbol, self.alor_timeframe, seconds_from, seconds_from + chunk_sec - 1)  # Первая часть истории
+        if not response or response.get('history', True):  # Если ошибка запроса или в первой части есть бары
+            return seconds_from  # то загружаем с начала выборки
+        if response.get('next'):  # Если Алор вернул дату и время следующего бара
+            return min(max(seconds_from, response['next']), seconds_end)  # то загружаем с него
+        seconds_low = seconds_from + chunk_sec  # До этого времени бар нет
+        seconds_high = seconds_end  # До этого времени бары есть
+        while True:  # Ищем с конца последнюю непустую часть
+            if seconds_high - chunk_sec < seconds_low:  # Если непустых частей нет
+                return seconds_low  # то загружаем оставшуюся часть
+            has_bars = self.has_history_bars(seconds_high - chunk_sec + 1, seconds_high)  # Есть ли бары в части
+            if has_bars is None:  # Если ошибка запроса
+                return seconds_low  # то загружаем с последнего известного пустого времени
+            if has_bars:  # Если бары есть
+                break  # то первый бар не позже окончания этой части
+            seconds_high -= chunk_sec  # Переходим к предыдущей части
+        while seconds_high - seconds_low > chunk_sec:  # Пока первый бар может быть дальше одной части
+            seconds_mid = (seconds_low + seconds_high) // 2  # Середина диапазона поиска
+            has_bars = self.has_history_bars(seconds_mid - chunk_sec + 1, seconds_mid)  # Есть ли бары в части, заканчивающейся в середине
+            if has_bars is None:  # Если ошибка запроса
+                break  # то загружаем с последнего известного пустого времени
+            if has_bars:  # Если в части есть бары
+                seconds_high = seconds_mid  # то первый бар не позже середины
+            else:  # Если бар в части нет
+                seconds_low = seconds_mid + 1  # то первый бар после середины
+        self.logger.debug(f'Бар в истории нет до {self.store.utc_timestamp_to_msk_datetime(seconds_low).strftime(self.dt_format)}')
+        return seconds_low
+
+    def has_history_bars(self, seconds_from, seconds_to) -> Union[bool, None]:
+        """Есть ли бары в истории в диапазоне. None - ошибка запроса"""
+        response = self.store.provider.get_history(self.exchange, self.symbol, self.alor_timeframe, seconds_from, seconds_to)  # Часть истории
+        if not response or 'history' not in response:  # Если ошибка запроса
+            return None
+        return len(response['history']) > 0
+
+    def get_history_chunks(self, seconds_from, seconds_to, chunk_sec) -> list:
+        """Разбивка диапазона загрузки истории на части по chunk_sec секунд
+
+        :param int seconds_from: Дата и время начала выборки в секундах
+        :param int seconds_to: Дата и время окончания выборки в секундах
+        :param int chunk_sec: Размер части истории в секундах
+        :return: Список частей (начало, окончание) в секундах по возрастанию
+        """
+        chunks = []  # Части истории
+        seconds_now = int(datetime.now(UTC).timestamp())  # Текущие дата и время в секундах
+        while seconds_from + chunk_sec <= min(seconds_to, seconds_now):  # Пока часть заканчивается до окончания выборки и текущего времени
+            chunks.append((seconds_from, seconds_from + chunk_sec - 1))  # Добавляем часть
+            seconds_from += chunk_sec  # Переходим к следующей части
+        chunks.append((seconds_from, seconds_to))  # Последняя часть до окончания выборки. Бар после текущего времени в ней нет
+        return chunks
+
+    def save_history_chunk(self, response) -> bool:
+        """Проверка и сохранение в файл бар части истории
+
+        :param dict response: Ответ на запрос части истории
+        :return: True - часть получена и сохранена, False - ошибка запроса
+        """
         if not response:  # Если в ответ ничего не получили
             self.logger.warning('Ошибка запроса бар из истории')
-            return  # то выходим, дальше не продолжаем
+            return False  # то часть не получена
         if 'history' not in response:  # Если бары не получены
             self.logger.error(f'Бар (history) нет в словаре {response}')
-            return  # то выходим, дальше не продолжаем
-        history_bars = response['history']  # Словарь полученных бар истории
-        for history_bar in history_bars:  # Пробегаемся по всем полученным барам
-            bar = dict(datetime=self.store.get_bar_open_date_time(history_bar['time'], self.intraday),
-                       open=history_bar['open'], high=history_bar['high'], low=history_bar['low'], close=history_bar['close'],  # Цены Alor
-                       volume=int(history_bar['volume']))  # Объем в лотах. Бар из истории
-            if self.is_bar_valid(bar):  # Если исторический бар соответствует всем условиям выборки
-                self.history_bars.append(bar)  # то добавляем бар
-                self.save_bar_to_file(bar)  # и сохраняем бар в файл
-        if len(self.history_bars) - file_history_bars_len > 0:  # Если получены бары из истории
-            self.logger.debug(f'Получено бар из истории: {len(self.history_bars) - file_history_bars_len} с {self.history_bars[file_history_bars_len]["datetime"].strftime(self.dt_format)} по {self.history_bars[-1]["datetime"].strftime(self.dt_format)}')
-        else:  # Бары из истории не получены
-            self.logger.debug('Из истории новых бар не получено')
+            return False  # то часть не получена
+        bars = Bars()  # Бары части истории
+        for history_bar in response['history']:  # Пробегаемся по всем полученным барам
+            bars.append_values(self.store.get_bar_open_seconds(history_bar['time'], self.intraday),
+                               history_bar['open'], history_bar['high'], history_bar['low'], history_bar['close'],  # Цены Alor
+                               history_bar['volume'])  # Объем в лотах. Бар из истории
+        new_bars = self.filter_bars(bars)  # Бары, соответствующие всем условиям выборки
+        self.history_bars.extend(new_bars)  # Добавляем их
+        self.save_bars_to_file(new_bars)  # Сохраняем все бары части в файл за одну запись. Если загрузка прервется, то следующая продолжится после этой части
+        return True  # Часть получена и сохранена
 
     def is_bar_valid(self, bar) -> bool:
         """Проверка бара на соответствие условиям выборки"""
-        dt_open = bar['datetime']  # Дата и время открытия бара МСК
+        dt_open = self.seconds_to_datetime(bar.seconds)  # Дата и время открытия бара МСК
         if dt_open <= self.dt_last_open:  # Если пришел бар из прошлого (дата открытия меньше последней даты открытия)
             self.logger.debug(f'Дата/время открытия бара {dt_open} <= последней даты/времени открытия {self.dt_last_open}')
+            self.store.metrics.inc('alor_bar_rejections_total', 'past')  # Причина для метрик
             return False  # то бар не соответствует условиям выборки
         if self.p.fromdate and dt_open < self.p.fromdate or self.p.todate and dt_open > self.p.todate:  # Если задан диапазон, а бар за его границами
             # self.logger.debug(f'Дата/время открытия бара {dt_open} за границами диапазона {self.p.fromdate} - {self.p.todate}')
+            self.store.metrics.inc('alor_bar_rejections_total', 'range')  # Причина для метрик
             self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
             return False  # то бар не соответствует условиям выборки
         if self.p.sessionstart != time.min and dt_open.time() < self.p.sessionstart:  # Если задано время начала сессии и открытие бара до этого времени
             self.logger.debug(f'Дата/время открытия бара {dt_open} до начала торговой сессии {self.p.sessionstart}')
+            self.store.metrics.inc('alor_bar_rejections_total', 'session_start')  # Причина для метрик
             self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
             return False  # то бар не соответствует условиям выборки
         dt_close = self.get_bar_close_date_time(dt_open)  # Дата и время закрытия бара
         if self.p.sessionend != time(23, 59, 59, 999990) and dt_close.time() > self.p.sessionend:  # Если задано время окончания сессии и закрытие бара после этого времени
             self.logger.debug(f'Дата/время открытия бара {dt_open} после окончания торговой сессии {self.p.sessionend}')
+            self.store.metrics.inc('alor_bar_rejections_total', 'session_end')  # Причина для метрик
             self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
             return False  # то бар не соответствует условиям выборки
-        if not self.p.four_price_doji and bar['high'] == bar['low']:  # Если не пропускаем дожи 4-х цен, но такой бар пришел
+        if not self.p.four_price_doji and bar.high == bar.low:  # Если не пропускаем дожи 4-х цен, но такой бар пришел
             self.logger.debug(f'Бар {dt_open} - дожи 4-х цен')
+            self.store.metrics.inc('alor_bar_rejections_total', 'doji')  # Причина для метрик
             self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
             return False  # то бар не соответствует условиям выборки
         dt_market_now = self.get_alor_date_time_now()  # Текущая дата и время из Alor
         dt_market_now_corrected = dt_market_now + timedelta(seconds=self.delta)  # Текущая дата и время из Alor с корректировкой
         if dt_close > dt_market_now_corrected and dt_market_now_corrected.time() < self.p.sessionend:  # Если время закрытия бара еще не наступило на бирже, и сессия еще не закончилась
             self.logger.debug(f'Дата/время {dt_close:{self.dt_format}} закрытия бара на {dt_open:{self.dt_format}} еще не наступило. Текущее время {dt_market_now:%d.%m.%Y %H:%M:%S}')
+            self.store.metrics.inc('alor_bar_rejections_total', 'not_closed')  # Причина для метрик
             return False  # то бар не соответствует условиям выборки
         self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
         return True  # В остальных случаях бар соответствуем условиям выборки
 
-    def stream_bars(self) -> None:
-        """Поток получения новых бар по расписанию биржи"""
-        self.logger.debug('Запуск получения новых бар по расписанию')
-        while True:
-            market_datetime_now = self.p.schedule.utc_to_msk_datetime(datetime.now(UTC))  # Текущее время на бирже
-            trade_bar_open_datetime = self.p.schedule.trade_bar_open_datetime(market_datetime_now, self.tf)  # Дата и время открытия бара, который будем получать
-            trade_bar_request_datetime = self.p.schedule.trade_bar_request_datetime(market_datetime_now, self.tf)  # Дата и время запроса бара на бирже
-            sleep_time_secs = (trade_bar_request_datetime - market_datetime_now).total_seconds()  # Время ожидания в секундах
-            self.logger.debug(f'Получение новых бар с {trade_bar_open_datetime.strftime(self.dt_format)} по расписанию в {trade_bar_request_datetime.strftime(self.dt_format)}. Ожидание {sleep_time_secs} с')
-            exit_event_set = self.exit_event.wait(sleep_time_secs)  # Ждем нового бара или события выхода из потока
-            if exit_event_set:  # Если произошло событие выхода из потока
-                self.logger.warning('Отмена получения новых бар по расписанию')
-                return  # Выходим из потока, дальше не продолжаем
-            seconds_from = self.p.schedule.msk_datetime_to_utc_timestamp(trade_bar_open_datetime)  # Дата и время бара в timestamp UTC
-            response = self.store.provider.get_history(self.exchange, self.symbol, self.alor_timeframe, seconds_from)  # Получаем ответ на запрос истории рынка
-            if not response:  # Если в ответ ничего не получили
-                self.logger.warning('Ошибка запроса бар из истории по расписанию')
-                continue  # то будем получать следующий бар
-            if 'history' not in response:  # Если бар нет в словаре
-                self.logger.warning(f'Бар (candles) нет в истории по расписанию {response}')
-                continue  # то будем получать следующий бар
-            bars = response['history']  # Последний сформированный и текущий несформированный (если имеется) бары
-            if len(bars) == 0:  # Если бары не получены
-                self.logger.warning('Новые бары по расписанию не получены')
-                continue  # то будем получать следующий бар
-            stream_bar = bars[0]  # Получаем первый (завершенный) бар
-            bar = dict(datetime=self.store.get_bar_open_date_time(stream_bar['time'], self.intraday),  # Дата и время открытия бара в зависимости от интервала
-                       open=stream_bar['open'], high=stream_bar['high'], low=stream_bar['low'], close=stream_bar['close'],  # Цены Alor
-                       volume=int(stream_bar['volume']))  # Объем в лотах. Бар по расписанию
-            self.logger.debug('Получен бар по расписанию')
-            self.store.new_bars.append(dict(guid=self.guid, data=bar))  # Добавляем в хранилище новых бар
+    def filter_bars(self, bars) -> Bars:
+        """Проверка бар истории на соответствие условиям выборки за один проход по колонкам
+        Границы диапазона переводятся в секунды, границы сессии - в микросекунды с начала дня один раз на все бары. Даты и время бар не создаются
+        Результат, причины для метрик и dt_last_open совпадают с проверкой каждого бара в is_bar_valid
 
-    def save_bar_to_file(self, bar) -> None:
-        """Сохранение бара в конец файла"""
-        if not os.path.isfile(self.file_name):  # Существует ли файл
-            self.logger.warning(f'Файл {self.file_name} не найден и будет создан')
-            with open(self.file_name, 'w', newline='') as file:  # Создаем файл
+        :param Bars bars: Бары по возрастанию даты и времени открытия
+        :return: Бары, соответствующие всем условиям выборки
+        """
+        close_offset = self.get_bar_close_offset()  # Длительность бара в секундах
+        if close_offset is None:  # Если дата и время закрытия бара не получаются сдвигом даты и времени открытия (месяцы, годы)
+            return Bars(bar for bar in bars if self.is_bar_valid(bar))  # то проверяем каждый бар
+        seconds, opens, highs, lows, closes, volumes = bars.get_columns()  # Колонки бар
+        last = self.datetime_to_seconds(self.dt_last_open)  # Дата и время открытия последнего полученного бара в секундах
+        last_changed = False  # Дата и время открытия последнего полученного бара не изменялись
+        from_bound = self.datetime_to_seconds(self.p.fromdate) + self.p.fromdate.microsecond / 1_000_000 if self.p.fromdate else None  # Начало диапазона в секундах
+        to_bound = self.datetime_to_seconds(self.p.todate) + self.p.todate.microsecond / 1_000_000 if self.p.todate else None  # Окончание диапазона в секундах
+        start_us = self.time_to_microseconds(self.p.sessionstart) if self.p.sessionstart != time.min else None  # Начало сессии в микросекундах с начала дня
+        end_us = self.time_to_microseconds(self.p.sessionend) if self.p.sessionend != time(23, 59, 59, 999990) else None  # Окончание сессии в микросекундах с начала дня
+        check_doji = not self.p.four_price_doji  # Пропускать дожи 4-х цен
+        dt_market_now_corrected = self.get_alor_date_time_now() + timedelta(seconds=self.delta)  # Текущая дата и время из Alor с корректировкой. Одна на все бары
+        now = self.datetime_to_seconds(dt_market_now_corrected) + dt_market_now_corrected.microsecond / 1_000_000  # в секундах
+        session_open = dt_market_now_corrected.time() < self.p.sessionend  # Сессия еще не закончилась
+        valid_bars = Bars()  # Бары, соответствующие всем условиям выборки
+        rejections = {}  # Кол-во бар, не прошедших проверку, по причине
+        for i, seconds_open in enumerate(seconds):  # Пробегаемся по всем барам. Порядок проверок как в is_bar_valid
+            if seconds_open <= last:  # Если бар из прошлого
+                reason = 'past'
+            else:
+                seconds_close = seconds_open + close_offset  # Дата и время закрытия бара в секундах
+                if from_bound is not None and seconds_open < from_bound or to_bound is not None and seconds_open > to_bound:  # Если бар за границами диапазона
+                    reason = 'range'
+                elif start_us is not None and seconds_open % 86400 * 1_000_000 < start_us:  # Если открытие бара до начала сессии
+                    reason = 'session_start'
+                elif end_us is not None and seconds_close % 86400 * 1_000_000 > end_us:  # Если закрытие бара после окончания сессии
+                    reason = 'session_end'
+                elif check_doji and highs[i] == lows[i]:  # Если бар - дожи 4-х цен
+                    reason = 'doji'
+                elif seconds_close > now and session_open:  # Если время закрытия бара еще не наступило на бирже
+                    reason = 'not_closed'
+                else:  # Бар соответствует всем условиям выборки
+                    reason = None
+                if reason != 'not_closed':  # Дату и время открытия незакрытого бара не запоминаем
+                    last = seconds_open  # Запоминаем дату и время открытия бара для будущих сравнений
+                    last_changed = True
+            if reason:  # Если бар не прошел проверку
+                rejections[reason] = rejections.get(reason, 0) + 1  # то запоминаем причину
+            else:  # Если бар прошел проверку
+                valid_bars.append_values(seconds_open, opens[i], highs[i], lows[i], closes[i], volumes[i])  # то добавляем его
+        if last_changed:  # Если дата и время открытия последнего полученного бара изменились
+            self.dt_last_open = self.seconds_to_datetime(last)  # то запоминаем их
+        for reason, count in rejections.items():  # Пробегаемся по всем причинам
+            self.store.metrics.inc('alor_bar_rejections_total', reason, count)  # Причина для метрик
+        if rejections:  # Если были бары, не прошедшие проверку
+            self.logger.debug(f'Бар не прошли проверку: {rejections}')
+        return valid_bars
+
+    def get_schedule_request(self) -> tuple:
+        """Следующий запрос нового бара по расписанию биржи
+
+        :return: Дата и время запроса, дата и время открытия бара в секундах
+        """
+        market_datetime_now = self.p.schedule.utc_to_msk_datetime(datetime.now(UTC))  # Текущее время на бирже
+        trade_bar_open_datetime = self.p.schedule.trade_bar_open_datetime(market_datetime_now, self.tf)  # Дата и время открытия бара, который будем получать
+        trade_bar_request_datetime = self.p.schedule.trade_bar_request_datetime(market_datetime_now, self.tf)  # Дата и время запроса бара на бирже
+        self.logger.debug(f'Получение новых бар с {trade_bar_open_datetime.strftime(self.dt_format)} по расписанию в {trade_bar_request_datetime.strftime(self.dt_format)}')
+        return self.p.schedule.msk_datetime_to_utc_timestamp(trade_bar_request_datetime), self.p.schedule.msk_datetime_to_utc_timestamp(trade_bar_open_datetime)
+
+    def get_schedule_bar(self, seconds_from) -> None:
+        """Получение нового бара по расписанию биржи. Вызывается из планировщика хранилища
+
+        :param int seconds_from: Дата и время открытия бара в секундах
+        """
+        response = self.store.provider.get_history(self.exchange, self.symbol, self.alor_timeframe, seconds_from)  # Получаем ответ на запрос истории рынка
+        if not response:  # Если в ответ ничего не получили
+            self.logger.warning('Ошибка запроса бар из истории по расписанию')
+            return  # то будем получать следующий бар
+        if 'history' not in response:  # Если бар нет в словаре
+            self.logger.warning(f'Бар (candles) нет в истории по расписанию {response}')
+            return  # то будем получать следующий бар
+        bars = response['history']  # Последний сформированный и текущий несформированный (если имеется) бары
+        if len(bars) == 0:  # Если бары не получены
+            self.logger.warning('Новые бары по расписанию не получены')
+            return  # то будем получать следующий бар
+        stream_bar = bars[0]  # Получаем первый (завершенный) бар
+        bar = Bar(self.store.get_bar_open_seconds(stream_bar['time'], self.intraday),  # Дата и время открытия бара в зависимости от интервала
+                  stream_bar['open'], stream_bar['high'], stream_bar['low'], stream_bar['close'],  # Цены Alor
+                  int(stream_bar['volume']))  # Объем в лотах. Бар по расписанию
+        self.logger.debug('Получен бар по расписанию')
+        self.store.put_new_bar(self.guid, bar)  # Добавляем в очередь новых бар
+
+    def save_bars_to_file(self, bars) -> None:
+        """Сохранение бар в конец файла за одну запись"""
+        if len(bars) == 0:  # Если бар нет
+            return  # то выходим, дальше не продолжаем
+        if self.p.binary_file:  # Если история хранится в бинарном файле
+            self.save_bars_to_bin_file(bars)  # то дописываем бары в колонки периодов
+        else:  # Если история хранится в текстовом файле
+            new_file = not os.path.isfile(self.file_name)  # Существует ли файл
+            if new_file:  # Если файла нет
+                self.logger.warning(f'Файл {self.file_name} не найден и будет создан')
+            with open(self.file_name, 'a', newline='') as file:  # Открываем файл на добавление в конец. Ставим newline, чтобы в Windows не создавались пустые строки в файле
                 writer = csv.writer(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
-                writer.writerow(bar.keys())  # Записываем заголовок в файл
-        with open(self.file_name, 'a', newline='') as file:  # Открываем файл на добавление в конец. Ставим newline, чтобы в Windows не создавались пустые строки в файле
-            writer = csv.writer(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
-            csv_row = bar.copy()  # Копируем бар для того, чтобы изменить формат даты
-            csv_row['datetime'] = csv_row['datetime'].strftime(self.dt_format)  # Приводим дату к формату файла
-            writer.writerow(csv_row.values())  # Записываем бар в конец файла
-            self.logger.debug(f'В файл {self.file_name} записан бар на {csv_row["datetime"]}')
+                if new_file:  # Если файл создан
+                    writer.writerow(self.csv_header)  # то записываем заголовок в файл
+                writer.writerows(self.bar_to_csv_row(bar) for bar in bars)  # Записываем все бары в конец файла. Буфер файла сбрасывается на диск при закрытии
+        self.logger.debug(f'В файл записано бар: {len(bars)} с {bars[0].datetime.strftime(self.dt_format)} по {bars[-1].datetime.strftime(self.dt_format)}')
+
+    def save_bar_to_file(self, bar) -> None:
+        """Сохранение нового бара в конец постоянно открытого файла"""
+        if self.p.binary_file:  # Если история хранится в бинарном файле
+            partition = bar.datetime.strftime(self.bin_partition)  # Период бара
+            if partition != self.live_partition:  # Если бар из другого периода
+                self.close_live_files()  # то закрываем колонки прошлого периода
+                os.makedirs(self.bin_path, exist_ok=True)  # Создаем папку бинарного файла, если ее нет
+                self.truncate_bin_partition(partition)  # Убираем не полностью записанный бар, чтобы колонки не сдвинулись
+                self.live_partition = partition  # Запоминаем период
+            files = [self.get_live_file(f'{self.bin_path}{partition}.{name}', 'ab') for name, _ in self.bin_columns]  # Открытые колонки периода
+            lengths = [file.tell() // array(typecode).itemsize for file, (_, typecode) in zip(files, self.bin_columns)]  # Кол-во значений в колонках с учетом буфера
+            if min(lengths) != max(lengths):  # Если запись прошлого бара была прервана
+                for file, length, (_, typecode) in zip(files, lengths, self.bin_columns):  # то пробегаемся по всем колонкам
+                    if length > min(lengths):  # Если в колонке есть значения не полностью записанного бара
+                        file.truncate(min(lengths) * array(typecode).itemsize)  # то обрезаем колонку до общего кол-ва бар. Буфер сбрасывается перед обрезкой
+                self.logger.warning(f'Не полностью записанный бар удален из колонок периода {partition} бинарного файла {self.bin_path}')
+            for file, (name, typecode) in zip(files, self.bin_columns):  # Пробегаемся по всем колонкам
+                value = bar.seconds if name == 'datetime' else getattr(bar, name)  # Значение бара для колонки
+                file.write(array(typecode, (value,)).tobytes())  # Дописываем значение в буфер колонки
+        else:  # Если история хранится в текстовом файле
+            if self.live_writer is None:  # Если файл еще не открыт
+                new_file = not os.path.isfile(self.file_name)  # Существует ли файл
+                if new_file:  # Если файла нет
+                    self.logger.warning(f'Файл {self.file_name} не найден и будет создан')
+                self.live_writer = csv.writer(self.get_live_file(self.file_name, 'a'), delimiter=self.delimiter)  # Данные в строке разделены табуляцией
+                if new_file:  # Если файл создан
+                    self.live_writer.writerow(self.csv_header)  # то записываем заголовок в файл
+            self.live_writer.writerow(self.bar_to_csv_row(bar))  # Записываем бар в буфер файла
+        self.logger.debug(f'В файл записан бар на {bar.datetime.strftime(self.dt_format)}')
+        self.unflushed_bars += 1  # Увеличиваем кол-во бар в буфере
+        if self.flush_bars and self.unflushed_bars >= self.flush_bars:  # Если пора сбросить буфер
+            self.flush_live_files()  # то сбрасываем буфер на диск
+
+    def get_live_file(self, file_name, mode):
+        """Открытый на запись новых бар файл"""
+        if file_name not in self.live_files:  # Если файл еще не открыт
+            self.live_files[file_name] = open(file_name, mode) if 'b' in mode else open(file_name, mode, newline='')  # то открываем его и оставляем открытым. Ставим newline, чтобы в Windows не создавались пустые строки в файле
+        return self.live_files[file_name]
+
+    def flush_live_files(self) -> None:
+        """Сброс буфера открытых файлов новых бар на диск"""
+        for file in self.live_files.values():  # Пробегаемся по всем открытым файлам
+            file.flush()  # Сбрасываем буфер в операционную систему
+            if self.fsync:  # Если нужно дождаться физической записи
+                os.fsync(file.fileno())  # то ждем записи на диск
+        self.unflushed_bars = 0  # Буфер пуст
+
+    def close_live_files(self) -> None:
+        """Сброс буфера на диск и закрытие открытых файлов новых бар"""
+        self.flush_live_files()  # Сбрасываем буфер на диск
+        for file in self.live_files.values():  # Пробегаемся по всем открытым файлам
+            file.close()  # Закрываем файл
+        self.live_files.clear()  # Открытых файлов больше нет
+        self.live_writer = None  # Запись в текстовый файл нужно будет открыть заново
+        self.live_partition = None  # Колонки периода нужно будет открыть заново
+
+    def bar_to_csv_row(self, bar) -> list:
+        """Строка текстового файла истории из бара"""
+        return [bar.datetime.strftime(self.dt_format), bar.open, bar.high, bar.low, bar.close, bar.volume]
+
+    def save_bars_to_bin_file(self, bars, bin_path=None) -> None:
+        """Сохранение бар в конец колонок бинарного файла с разбивкой по периодам"""
+        bin_path = bin_path or self.bin_path  # Папка бинарного файла
+        os.makedirs(bin_path, exist_ok=True)  # Создаем папку, если ее нет
+        partitions = {}  # Колонки бар по периодам
+        for bar in bars:  # Пробегаемся по всем барам
+            partition = bar.datetime.strftime(self.bin_partition)  # Период бара
+            if partition not in partitions:  # Если период встретился впервые
+                partitions[partition] = [array(typecode) for _, typecode in self.bin_columns]  # то создаем пустые колонки
+            columns = partitions[partition]  # Колонки периода
+            columns[0].append(bar.seconds)  # Дата и время открытия бара в секундах
+            for column, (name, _) in zip(columns[1:], self.bin_columns[1:]):  # Пробегаемся по колонкам цен и объема
+                column.append(getattr(bar, name))  # Добавляем значение бара в колонку
+        for partition, columns in partitions.items():  # Пробегаемся по всем периодам
+            self.truncate_bin_partition(partition, bin_path)  # Убираем не полностью записанный бар, чтобы колонки не сдвинулись
+            for column, (name, _) in zip(columns, self.bin_columns):  # Пробегаемся по всем колонкам периода
+                with open(f'{bin_path}{partition}.{name}', 'ab') as file:  # Открываем файл колонки на добавление в конец
+                    column.tofile(file)  # Дописываем значения одной операцией
+
+    def truncate_bin_partition(self, partition, bin_path=None) -> None:
+        """Обрезка колонок периода бинарного файла до общего кол-ва бар. Если запись бара была прервана, то бар удаляется из всех колонок"""
+        bin_path = bin_path or self.bin_path  # Папка бинарного файла
+        file_names = [f'{bin_path}{partition}.{name}' for name, _ in self.bin_columns]  # Файлы колонок периода
+        sizes = [os.path.getsize(file_name) if os.path.isfile(file_name) else 0 for file_name in file_names]  # Размеры колонок в байтах
+        itemsizes = [array(typecode).itemsize for _, typecode in self.bin_columns]  # Размеры значений колонок в байтах
+        length = min(size // itemsize for size, itemsize in zip(sizes, itemsizes))  # Кол-во полностью записанных бар
+        for file_name, size, itemsize in zip(file_names, sizes, itemsizes):  # Пробегаемся по всем колонкам
+            if size != length * itemsize:  # Если в колонке есть значения не полностью записанного бара
+                self.logger.warning(f'Колонка {file_name} обрезана с {size} до {length * itemsize} байт. Запись бара была прервана')
+                os.truncate(file_name, length * itemsize)  # то обрезаем колонку до общего кол-ва бар
+
+    def txt_to_bin_file(self) -> None:
+        """Однократный перевод текстового файла истории в бинарный"""
+        self.logger.info(f'Перевод файла {self.file_name} в бинарный файл {self.bin_path}')
+        tmp_path = os.path.join(f'{self.datapath}{self.file}.tmp', '')  # Временная папка. Если перевод прервется, то бинарный файл не будет поврежден
+        if os.path.isdir(tmp_path):  # Если осталась временная папка от прерванного перевода
+            for file_name in os.listdir(tmp_path):  # то удаляем все ее файлы
+                os.remove(f'{tmp_path}{file_name}')
+        self.save_bars_to_bin_file(self.read_txt_file(), tmp_path)  # Сохраняем все бары текстового файла в колонки временной папки
+        os.replace(tmp_path, self.bin_path)  # Переименовываем временную папку в папку бинарного файла
 
     # Функции
 
@@ -304,6 +937,31 @@ class ALData(with_metaclass(MetaALData, AbstractDataBase)):
             return 'Y1'
         raise NotImplementedError  # С остальными временнЫми интервалами не работаем
 
+    def tf_to_seconds(self, tf) -> Union[int, None]:
+        """Длительность бара временнОго интервала для имени файла истории в секундах. Для интервалов больше дня None"""
+        if tf.startswith('M') and tf[1:].isdigit():  # Минутный временной интервал
+            return int(tf[1:]) * 60
+        if tf == 'D1':  # Дневной временной интервал
+            return 86400
+        return None
+
+    def get_bar_close_offset(self) -> Union[int, None]:
+        """Сдвиг даты и времени закрытия бара от даты и времени открытия в секундах, как в get_bar_close_date_time. Для месяцев и лет сдвиг не постоянный - None"""
+        if self.p.timeframe == TimeFrame.Days:  # Дневной временной интервал
+            return 86400
+        elif self.p.timeframe == TimeFrame.Weeks:  # Недельный временной интервал
+            return 7 * 86400
+        elif self.p.timeframe == TimeFrame.Minutes:  # Минутный временной интервал
+            return self.p.compression * 60
+        elif self.p.timeframe == TimeFrame.Seconds:  # Секундный временной интервал
+            return self.p.compression
+        return None
+
+    @staticmethod
+    def time_to_microseconds(t) -> int:
+        """Перевод времени в кол-во микросекунд с начала дня"""
+        return ((t.hour * 60 + t.minute) * 60 + t.second) * 1_000_000 + t.microsecond
+
     def get_seconds_from(self) -> int:
         """Дата и время начала выборки в кол-ве секунд, прошедших с 01.01.1970 00:00 UTC"""
         if self.dt_last_open > datetime.min:  # Если в файле были бары
@@ -312,7 +970,7 @@ class ALData(with_metaclass(MetaALData, AbstractDataBase)):
         #     dt = self.p.fromdate  # то время начала выборки берем из даты и времени начала интервала
         else:  # Если бар из файла нет и не заданы дата и время начала интервала
             return 0  # то время начала выборки берем минимально возможное
-        return self.store.provider.msk_datetime_to_utc_timestamp(dt)
+        return self.store.msk_datetime_to_utc_timestamp(dt)
 
     def get_bar_close_date_time(self, dt_open, period=1) -> datetime:
         """Дата и время закрытия бара"""
@@ -332,10 +990,53 @@ class ALData(with_metaclass(MetaALData, AbstractDataBase)):
             return dt_open + timedelta(seconds=self.p.compression * period)  # Время закрытия бара
         raise NotImplementedError  # С остальными временнЫми интервалами не работаем
 
+    @staticmethod
+    def datetime_to_seconds(dt) -> int:
+        """Перевод даты и времени бара в кол-во секунд, прошедших с 01.01.1970 00:00 без учета временнОй зоны"""
+        return timegm(dt.timetuple())
+
+    @staticmethod
+    def seconds_to_datetime(seconds) -> datetime:
+        """Перевод кол-ва секунд, прошедших с 01.01.1970 00:00, в дату и время бара без временнОй зоны"""
+        return datetime(1970, 1, 1) + timedelta(seconds=seconds)
+
+    @staticmethod
+    def seconds_to_num(seconds) -> float:
+        """Перевод кол-ва секунд, прошедших с 01.01.1970 00:00, в формат хранения даты/времени в BackTrader. Результат совпадает с date2num"""
+        days, seconds = divmod(seconds, 86400)  # Кол-во дней и секунд с начала дня
+        hours, seconds = divmod(seconds, 3600)  # Часы и секунды с начала часа
+        minutes, seconds = divmod(seconds, 60)  # Минуты и секунды
+        return fsum((float(719163 + days), hours / 24, minutes / 1440, seconds / 86400))  # 719163 - номер дня 01.01.1970 от 01.01.0001
+
+    def bar_to_lines(self, bar) -> tuple:
+        """Цены и объем бара для линий BackTrader"""
+        return (self.alor_prices_to_prices(bar.open), self.alor_prices_to_prices(bar.high), self.alor_prices_to_prices(bar.low), self.alor_prices_to_prices(bar.close),
+                self.lots_to_sizes(int(bar.volume)))
+
+    def alor_prices_to_prices(self, alor_prices):
+        """Перевод цены или колонки цен Алор в цены в рублях за штуку
+
+        :param float|array alor_prices: Цена или колонка цен Алор
+        :return: Цена или колонка цен в рублях за штуку
+        """
+        if isinstance(alor_prices, (int, float)):  # Если переводим одну цену
+            return alor_prices * self.price_ratio  # то просто умножаем ее на коэффициент
+        return array('d', map(self.price_ratio.__mul__, alor_prices))  # Колонку переводим за один проход
+
+    def lots_to_sizes(self, lots):
+        """Перевод кол-ва лотов или колонки кол-ва лотов в кол-во штук
+
+        :param int|array lots: Кол-во лотов или колонка кол-ва лотов
+        :return: Кол-во штук или колонка кол-ва штук
+        """
+        if isinstance(lots, int):  # Если переводим одно кол-во
+            return int(lots * self.size_ratio)  # то просто умножаем его на коэффициент
+        return array('d', map(int, map(self.size_ratio.__mul__, lots)))  # Колонку переводим за один проход
+
     def get_alor_date_time_now(self) -> datetime:
         """Текущая дата и время
-        - Если получили последний бар истории, то запрашием текущие дату и время с сервера Алор
+        - Если получили последний бар истории, то берем текущие дату и время сервера Алор из хранилища без запроса к серверу
         - Если находимся в режиме получения истории, то переводим текущие дату и время с компьютера в МСК
         """
-        return self.store.provider.utc_timestamp_to_msk_datetime(self.store.provider.get_time()) if self.last_bar_received\
-            else datetime.now(self.store.provider.tz_msk).replace(tzinfo=None)
+        return self.store.get_alor_date_time_now() if self.last_bar_received\
+            else datetime.now(self.store.tz_msk).replace(tzinfo=None)
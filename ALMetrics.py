@@ -0,0 +1,191 @@
+import logging  # Будем вести лог
+from bisect import bisect_left  # Поиск корзины гистограммы
+from threading import Thread, Event, Lock  # Поток выгрузки метрик, событие остановки потока, блокировка изменения метрик
+import os.path
+
+
+class Histogram:
+    """Гистограмма времени выполнения этапа в секундах"""
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Верхние границы корзин в секундах
+
+    def __init__(self, name, documentation):
+        self.name = name  # Имя метрики
+        self.documentation = documentation  # Описание метрики
+        self.counts = [0] * (len(self.buckets) + 1)  # Кол-во значений по корзинам. Последняя корзина для значений больше всех границ
+        self.sum = 0.0  # Сумма значений
+        self.count = 0  # Кол-во значений
+        self.lock = Lock()  # Значения добавляются из разных потоков
+
+    def observe(self, value) -> None:
+        """Добавление значения
+
+        :param float value: Значение в секундах
+        """
+        i = bisect_left(self.buckets, value)  # Корзина значения
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> dict:
+        """Значения гистограммы: кол-во значений по корзинам нарастающим итогом, сумма и кол-во значений"""
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = []  # Кол-во значений не больше границы корзины
+        running = 0
+        for bucket_count in counts:  # Пробегаемся по всем корзинам
+            running += bucket_count
+            cumulative.append(running)
+        return dict(buckets=dict(zip((*self.buckets, float('inf')), cumulative)), sum=total, count=count)
+
+    def to_prometheus(self) -> list:
+        """Строки гистограммы в текстовом формате Prometheus"""
+        snapshot = self.snapshot()
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for le, count in snapshot['buckets'].items():  # Пробегаемся по всем корзинам
+            lines.append(f'{self.name}_bucket{{le="{"+Inf" if le == float("inf") else le}"}} {count}')
+        lines.append(f'{self.name}_sum {snapshot["sum"]}')
+        lines.append(f'{self.name}_count {snapshot["count"]}')
+        return lines
+
+
+class Counter:
+    """Счетчик событий с необязательной меткой"""
+    def __init__(self, name, documentation, label=None):
+        self.name = name  # Имя метрики
+        self.documentation = documentation  # Описание метрики
+        self.label = label  # Имя метки. Например, reason
+        self.values = {}  # Значения по метке. Без метки значение по ключу None
+        self.lock = Lock()  # Значения изменяются из разных потоков
+
+    def inc(self, label_value=None, value=1) -> None:
+        """Увеличение счетчика
+
+        :param str label_value: Значение метки
+        :param int value: На сколько увеличить счетчик
+        """
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + value
+
+    def snapshot(self) -> dict:
+        """Значения счетчика по метке"""
+        with self.lock:
+            return dict(self.values)
+
+    def to_prometheus(self) -> list:
+        """Строки счетчика в текстовом формате Prometheus"""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for label_value, value in self.snapshot().items():  # Пробегаемся по всем значениям метки
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value}' if self.label else f'{self.name} {value}')
+        return lines
+
+
+class Gauge:
+    """Текущее значение. Например, глубина очереди. Вычисляется функцией при чтении и не нагружает основной поток"""
+    def __init__(self, name, documentation, function):
+        self.name = name  # Имя метрики
+        self.documentation = documentation  # Описание метрики
+        self.function = function  # Функция получения текущего значения
+
+    def snapshot(self) -> float:
+        """Текущее значение"""
+        try:
+            return self.function()
+        except Exception:  # Если значение не получено (например, объект уже остановлен)
+            return float('nan')
+
+    def to_prometheus(self) -> list:
+        """Строки значения в текстовом формате Prometheus"""
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge', f'{self.name} {self.snapshot()}']
+
+
+class ALMetrics:
+    """Метрики задержек и пропускной способности хранилища, данных и брокера Алор"""
+    logger = logging.getLogger('ALMetrics')  # Будем вести лог
+    enabled = True  # Собирать метрики. Сбор стоит несколько микросекунд на событие, поэтому его можно не отключать
+
+    def __init__(self):
+        self.metrics = {}  # Метрики по имени
+        self.lock = Lock()  # Блокировка регистрации метрик
+        self.exporter_exit_event = Event()  # Событие остановки потока выгрузки метрик
+        self.exporter_thread = None  # Поток выгрузки метрик в файл
+
+    def register(self, metric):
+        """Регистрация метрики. Если метрика с таким именем уже есть, то возвращается она"""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name, documentation) -> Histogram:
+        """Гистограмма времени выполнения этапа"""
+        return self.register(Histogram(name, documentation))
+
+    def counter(self, name, documentation, label=None) -> Counter:
+        """Счетчик событий"""
+        return self.register(Counter(name, documentation, label))
+
+    def gauge(self, name, documentation, function) -> Gauge:
+        """Текущее значение, получаемое функцией"""
+        with self.lock:
+            self.metrics[name] = Gauge(name, documentation, function)  # Функция заменяется. Например, при создании нового брокера
+            return self.metrics[name]
+
+    def observe(self, name, value) -> None:
+        """Добавление значения в зарегистрированную гистограмму"""
+        if self.enabled:  # Если метрики собираются
+            self.metrics[name].observe(value)
+
+    def inc(self, name, label_value=None, value=1) -> None:
+        """Увеличение зарегистрированного счетчика"""
+        if self.enabled:  # Если метрики собираются
+            self.metrics[name].inc(label_value, value)
+
+    def snapshot(self) -> dict:
+        """Значения всех метрик по имени"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def to_prometheus(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.to_prometheus()) + '\n'
+
+    def write_prometheus(self, file_name) -> None:
+        """Сохранение всех метрик в файл для Prometheus node_exporter textfile collector
+
+        :param str file_name: Полное имя файла. Должно заканчиваться на .prom
+        """
+        tmp_file_name = f'{file_name}.tmp'  # Временный файл. Prometheus не должен прочитать файл во время записи
+        with open(tmp_file_name, 'w', encoding='utf-8') as file:
+            file.write(self.to_prometheus())
+        os.replace(tmp_file_name, file_name)  # Заменяем файл метрик
+
+    def start_exporter(self, file_name, interval_sec=15) -> None:
+        """Запуск потока выгрузки метрик в файл каждые interval_sec секунд
+
+        :param str file_name: Полное имя файла. Должно заканчиваться на .prom
+        :param float interval_sec: Интервал выгрузки в секундах
+        """
+        self.stop_exporter()  # Останавливаем прошлую выгрузку, если была
+        self.exporter_exit_event.clear()
+        self.exporter_thread = Thread(target=self.stream_exporter, args=(file_name, interval_sec), name='ALMetricsExporter', daemon=True)
+        self.exporter_thread.start()
+
+    def stop_exporter(self) -> None:
+        """Остановка потока выгрузки метрик"""
+        if self.exporter_thread is None:  # Если выгрузка не запускалась
+            return  # то выходим, дальше не продолжаем
+        self.exporter_exit_event.set()  # Останавливаем поток
+        self.exporter_thread.join()  # Дожидаемся последней выгрузки
+        self.exporter_thread = None
+
+    def stream_exporter(self, file_name, interval_sec) -> None:
+        """Поток выгрузки метрик в файл"""
+        exit_event_set = False  # Выгрузку не останавливали
+        while not exit_event_set:  # Пока выгрузку не остановили
+            exit_event_set = self.exporter_exit_event.wait(interval_sec)  # Ждем interval_sec секунд или остановки выгрузки. При остановке сохраняем метрики последний раз
+            try:
+                self.write_prometheus(file_name)  # Сохраняем метрики
+            except OSError as e:  # Если файл не записан
+                self.logger.warning(f'Метрики не сохранены в файл {file_name}: {e}')
@@ -1,12 +1,22 @@
 import logging  # Будем вести лог
-from collections import deque
+from collections import deque  # Очередь
 from datetime import datetime, UTC
+from zoneinfo import ZoneInfo  # ВременнАя зона биржи
+from time import time, perf_counter  # Текущее время компьютера для расчета времени на сервере, время для метрик
+from threading import Thread, Event, Lock, Condition  # Потоки синхронизации времени и планировщика, событие остановки, блокировка запуска синхронизации, условие изменения расписания
+from heapq import heappush, heappop  # Очередь запросов планировщика по времени запроса
+from concurrent.futures import ThreadPoolExecutor  # Пул потоков для параллельной подготовки данных
+import os.path
+import json  # Файл кэша информации о тикерах и счетах
 
 from backtrader.metabase import MetaParams
 from backtrader.utils.py3 import with_metaclass
 
 from AlorPy import AlorPy
 
+from BackTraderAlor.ALMetrics import ALMetrics
+from BackTraderAlor.ALBar import Bar, BarQueue
+
 
 class MetaSingleton(MetaParams):
     """Метакласс для создания Singleton классов"""
@@ -26,8 +36,20 @@ class ALStore(with_metaclass(MetaSingleton, object)):
     """Хранилище Алор"""
     logger = logging.getLogger('ALStore')  # Будем вести лог
 
+    tz_msk = ZoneInfo('Europe/Moscow')  # Время UTC в Alor OpenAPI будем приводить к московскому времени биржи
     BrokerCls = None  # Класс брокера будет задан из брокера
     DataCls = None  # Класс данных будет задан из данных
+    time_sync_sec = 60  # Через сколько секунд в фоне пересинхронизировать время с сервером Алор
+    time_sync_retry_sec = 1  # Через сколько секунд повторить синхронизацию после ошибки. При каждой следующей ошибке интервал удваивается до time_sync_sec
+    metadata_file_name = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Data', 'Alor', 'metadata.json')  # Файл кэша информации о тикерах и счетах
+    metadata_ttl_sec = 24 * 60 * 60  # Сколько секунд информация из кэша считается актуальной. 0 - не использовать кэш
+    schedule_workers = 8  # Кол-во потоков для одновременных запросов новых бар по расписанию. Не зависит от кол-ва данных
+    bar_queue_maxlen = 10_000  # Максимальное кол-во бар в очереди новых бар данных. 0 - без ограничения
+    bar_queue_policy = 'coalesce'  # Политика переполнения очереди новых бар: 'block' - ждать места, 'drop_oldest' - удалять самый старый бар, 'coalesce' - заменять бар с той же датой и временем открытия, иначе удалять самый старый
+    bar_queue_block_sec = 1  # Максимальное время ожидания места в очереди новых бар для политики 'block'. Ожидание задерживает поток WebSocket
+    bar_queue_orphan_sec = 60  # Через сколько секунд без обращения данных очередь новых бар закрывается, если ее данные остановлены
+    subscription_bars = 100  # Кол-во последних бар подписки, которые получат данные, подписавшиеся позже
+    warm_up_workers = 8  # Кол-во потоков для параллельной подготовки данных (информация о тикере, бары из файла и истории)
 
     @classmethod
     def getdata(cls, *args, **kwargs):
@@ -39,13 +61,61 @@ class ALStore(with_metaclass(MetaSingleton, object)):
         """Возвращает новый экземпляр класса брокера с заданными параметрами"""
         return cls.BrokerCls(*args, **kwargs)
 
-    def __init__(self, provider=AlorPy()):
+    def __init__(self, provider=None):
         super(ALStore, self).__init__()
         self.notifs = deque()  # Уведомления хранилища
-        self.provider = provider  # Подключаемся к провайдеру AlorPy
-        self.new_bars = []  # Новые бары по всем подпискам на тикеры из Алор
+        self.alor_provider = provider  # Провайдер AlorPy. Если не задан, то подключаемся при первом обращении. Провайдер можно подменить, например, для замеров производительности без подключения к Алор
+        self.provider_lock = Lock()  # Блокировка подключения к провайдеру. Данные подготавливаются параллельно
+        self.started = False  # Хранилище не запущено
+        self.datas = []  # Данные, добавленные в cerebro
+        self.new_bars = {}  # Ограниченные очереди новых бар по идентификатору подписки/расписания. Добавление и извлечение из очереди потокобезопасны
+        self.new_bars_lock = Lock()  # Блокировка открытия, закрытия и очистки очередей новых бар
+        self.new_bars_sweep_time = perf_counter()  # Время последнего поиска очередей, которые никто не разбирает
+        self.metrics = ALMetrics()  # Метрики задержек и пропускной способности
+        self.metrics.histogram('alor_new_candle_seconds', 'Время обработки бара из WebSocket в on_new_candle')
+        self.metrics.histogram('alor_bar_delivery_seconds', 'Время от постановки нового бара в очередь до выдачи в _load')
+        self.metrics.counter('alor_new_bars_total', 'Кол-во новых бар, поставленных в очередь')
+        self.metrics.counter('alor_bar_rejections_total', 'Кол-во бар, не прошедших проверку is_bar_valid, по причине', 'reason')
+        self.metrics.counter('alor_new_bar_drops_total', 'Кол-во новых бар, удаленных из очередей или не поставленных в очередь, по причине', 'reason')
+        self.metrics.gauge('alor_new_bars_queue_depth', 'Кол-во новых бар во всех очередях', lambda: sum(len(new_bars) for new_bars in list(self.new_bars.values())))
+        self.time_offset = None  # Разница в секундах между временем сервера Алор и временем компьютера. Пока не синхронизировали
+        self.time_sync_lock = Lock()  # Блокировка первой синхронизации времени
+        self.time_sync_started = False  # Запущена ли синхронизация времени. Первый запрос к серверу выполняется один раз, даже если сервер не ответил
+        self.time_sync_exit_event = Event()  # Событие остановки потока синхронизации времени
+        self.schedule = []  # Очередь запросов новых бар по расписанию (время запроса, guid, данные, время открытия бара)
+        self.schedule_guids = set()  # Идентификаторы расписаний данных, получающих новые бары по расписанию
+        self.schedule_condition = Condition()  # Условие изменения расписания
+        self.schedule_thread = None  # Поток планировщика. Запускается с первым расписанием
+        self.bar_subscriptions = {}  # Подписки на бары по бирже, тикеру и интервалу Алор: guid подписки, время начала, данные, последние бары
+        self.bar_subscription_keys = {}  # Биржа, тикер и интервал Алор подписки на бары по guid подписки
+        self.bar_subscriptions_lock = Lock()  # Блокировка изменения подписок на бары
+        self.metadata = self.load_metadata()  # Кэш информации о тикерах и счетах
+        self.metadata_lock = Lock()  # Блокировка изменения кэша. Данные подготавливаются параллельно
+        self.metadata_changed = False  # Кэш не изменялся
+
+    @property
+    def provider(self) -> AlorPy:
+        """Провайдер AlorPy. Подключаемся при первом обращении. Без подключения к Алор (offline) данные к провайдеру не обращаются"""
+        if self.alor_provider is None:  # Если к провайдеру еще не подключались
+            with self.provider_lock:  # Подключаемся только из одного потока
+                if self.alor_provider is None:  # Если не подключились, пока ждали блокировку
+                    self.alor_provider = AlorPy()  # то подключаемся к провайдеру AlorPy
+                    if self.started:  # Если хранилище уже запущено
+                        self.set_provider_handlers()  # то устанавливаем обработчики событий провайдера
+        return self.alor_provider
+
+    @provider.setter
+    def provider(self, provider) -> None:
+        self.alor_provider = provider
 
     def start(self):
+        self.started = True  # Хранилище запущено
+        if self.alor_provider is not None:  # Если к провайдеру уже подключились
+            self.set_provider_handlers()  # то устанавливаем обработчики событий провайдера. Иначе установим при подключении
+        self.warm_up_datas()  # Cerebro запускает хранилище до данных. Запускаем параллельную подготовку всех данных
+
+    def set_provider_handlers(self) -> None:
+        """Установка обработчиков событий провайдера"""
         self.provider.on_entering = lambda: self.logger.debug(f'WebSocket Thread: Запуск')
         self.provider.on_enter = lambda: self.logger.debug(f'WebSocket Thread: Запущен')
         self.provider.on_connect = lambda: self.logger.debug(f'WebSocket Task: Подключен к серверу')
@@ -58,6 +128,35 @@ class ALStore(with_metaclass(MetaSingleton, object)):
         self.provider.on_exit = lambda: self.logger.debug(f'WebSocket Thread: Завершение')
         self.provider.on_new_bar = self.on_new_candle  # Обработчик новых баров по подписке из Алор
 
+    def warm_up_datas(self):
+        """Параллельная подготовка всех зарегистрированных данных в пуле из warm_up_workers потоков
+        Каждые данные при запуске забирают готовый результат. Время подготовки определяется самыми долгими данными, а не суммой по всем данным
+        """
+        datas = [data for data in self.datas if data.warm_up_future is None]  # Данные, подготовка которых еще не запускалась
+        if len(datas) < 2:  # Если распараллеливать нечего
+            return  # то данные подготовятся сами при запуске
+        self.logger.debug(f'Параллельная подготовка данных: {len(datas)}')
+        pool = ThreadPoolExecutor(max_workers=self.warm_up_workers, thread_name_prefix='ALStoreWarmUp')  # Пул потоков подготовки данных
+        file_futures = {}  # Подготовка первых данных по файлу истории (тикер, интервал, бинарный файл)
+        for data in sorted(datas, key=lambda data: data.p.base_tf is not None):  # Пробегаемся по всем данным. Данные, бары которых строятся из других данных, ставим в конец очереди. Они дожидаются своих базовых данных
+            key = (data.p.dataname, data.tf, data.p.binary_file)  # Данные с таким ключом читают и дописывают один файл истории
+            if key in file_futures:  # Если файл истории уже подготавливают другие данные
+                data.warm_up_future = pool.submit(self.warm_up_after, data, file_futures[key])  # то готовим данные после них. Иначе бары будут загружены и дописаны в файл дважды
+            else:  # Если данные первые по файлу истории
+                data.warm_up_future = file_futures[key] = pool.submit(data.warm_up)  # то ставим подготовку данных в очередь пула
+        pool.shutdown(wait=False)  # Потоки пула завершатся после подготовки всех данных
+
+    @staticmethod
+    def warm_up_after(data, future) -> None:
+        """Подготовка данных после подготовки других данных с тем же файлом истории
+        Первые данные загружают историю и дописывают ее в файл. Эти данные получают бары из уже дописанного файла со своими условиями выборки
+
+        :param ALData data: Данные
+        :param Future future: Подготовка первых данных по файлу истории. Поставлена в очередь пула раньше, поэтому ожидание не блокирует пул
+        """
+        future.exception()  # Дожидаемся окончания подготовки. Ошибку первых данных они получат сами
+        data.warm_up()  # Готовим данные
+
     def put_notification(self, msg, *args, **kwargs):
         self.notifs.append((msg, args, kwargs))
 
@@ -67,22 +166,337 @@ class ALStore(with_metaclass(MetaSingleton, object)):
         return [x for x in iter(self.notifs.popleft, None)]
 
     def stop(self):
-        self.provider.on_new_bar = self.provider.default_handler  # Возвращаем обработчик по умолчанию
-        self.provider.close_web_socket()  # Перед выходом закрываем соединение с WebSocket
+        self.save_metadata()  # Сохраняем кэш информации о тикерах и счетах для следующего запуска
+        with self.time_sync_lock:  # Синхронизацию могут запускать из другого потока
+            self.time_sync_exit_event.set()  # Останавливаем поток синхронизации времени
+            self.time_sync_started = False  # При следующем запуске время нужно будет синхронизировать заново
+            self.time_offset = None
+        with self.schedule_condition:  # Останавливаем поток планировщика
+            self.schedule_guids.clear()  # Отменяем все расписания
+            self.schedule.clear()  # и запросы
+            self.schedule_condition.notify()  # Будим планировщик
+        self.started = False  # Хранилище остановлено
+        if self.alor_provider is not None:  # Если подключались к провайдеру
+            self.provider.on_new_bar = self.provider.default_handler  # Возвращаем обработчик по умолчанию
+            self.provider.close_web_socket()  # Перед выходом закрываем соединение с WebSocket
 
     def on_new_candle(self, response):
+        start = perf_counter()  # Начало обработки бара для метрик
         guid = response['guid']  # Идентификатор подписки
         if guid not in self.provider.subscriptions:  # Если подписки по такому индентификатору не существует
             return  # то выходим, дальше не продолжаем
         subscription = self.provider.subscriptions[guid]  # Данные подписки
         bar = response['data']  # Данные бара
         intraday = subscription['tf'].isdigit()  # Если время задано в секундах (число), то считаем, что интервал внутридневной
-        bar = dict(datetime=self.get_bar_open_date_time(bar['time'], intraday),  # Дата и время открытия бара в зависимости от интервала
-                   open=bar['open'], high=bar['high'], low=bar['low'], close=bar['close'],  # Цены Alor
-                   volume=int(bar['volume']))  # Объем в лотах. Бар из подписки
-        self.new_bars.append(dict(guid=guid, data=bar))
+        bar = Bar(self.get_bar_open_seconds(bar['time'], intraday),  # Дата и время открытия бара в зависимости от интервала
+                  bar['open'], bar['high'], bar['low'], bar['close'],  # Цены Alor
+                  int(bar['volume']))  # Объем в лотах. Бар из подписки
+        with self.bar_subscriptions_lock:  # Бар запоминаем и рассылаем данным, подписанным на момент его прихода
+            key = self.bar_subscription_keys.get(guid)  # Подписка на бары
+            if key is None:  # Если подписку уже отменили или заменили
+                return  # то выходим, дальше не продолжаем
+            subscription = self.bar_subscriptions[key]
+            subscription['bars'].append(bar)  # Последние бары для данных, которые подпишутся позже
+            datas = subscription['datas']
+        for data in datas:  # Пробегаемся по всем данным подписки
+            data.on_new_bar(bar)  # Один и тот же бар отдаем всем данным. Данные его не изменяют
+        self.metrics.observe('alor_new_candle_seconds', perf_counter() - start)  # Время обработки бара
+
+    def subscribe_bars(self, data, tf, seconds_from) -> None:
+        """Подписка данных на новые бары. По бирже, тикеру и интервалу на сервере Алор одна подписка для всех данных
+
+        :param ALData data: Данные
+        :param str tf: Интервал Алор
+        :param int seconds_from: Дата и время начала выборки в секундах
+        """
+        key = (data.exchange, data.symbol, tf)  # Биржа, тикер и интервал Алор
+        with self.bar_subscriptions_lock:  # Изменяем подписки только из одного потока
+            subscription = self.bar_subscriptions.get(key)  # Подписка на бары
+            if subscription is None or seconds_from < subscription['seconds_from'] or self.is_bars_truncated(subscription, seconds_from, tf):  # Если подписки нет, или данным нужны более ранние бары, или нужные бары уже не хранятся
+                datas = subscription['datas'] if subscription else []  # Данные подписки. Повторно полученные бары данные пропустят
+                if subscription:  # Если подписка уже есть
+                    del self.bar_subscription_keys[subscription['guid']]  # то заменяем ее на подписку с более ранних бар
+                    self.provider.unsubscribe(subscription['guid'])
+                guid = self.provider.bars_get_and_subscribe(data.exchange, data.symbol, tf, seconds_from, frequency=1_000_000_000)  # Подписываемся на бары, получаем guid подписки
+                self.logger.debug(f'Подписка {guid} на бары {data.exchange}.{data.symbol} {tf}')
+                subscription = self.bar_subscriptions[key] = dict(guid=guid, seconds_from=seconds_from, datas=datas, bars=deque(maxlen=self.subscription_bars))
+                self.bar_subscription_keys[guid] = key
+            else:  # Если подписка уже есть
+                for bar in subscription['bars']:  # Последние бары подписки
+                    data.on_new_bar(bar)  # отдаем данным, чтобы они не пропустили бары, пришедшие до подключения к подписке
+            subscription['datas'] = subscription['datas'] + [data]  # Список заменяем, а не изменяем. Обработчик новых бар пробегается по нему без блокировки
+
+    def is_bars_truncated(self, subscription, seconds_from, tf) -> bool:
+        """Удалены ли из последних бар подписки бары, нужные данным
+
+        :param dict subscription: Подписка на бары
+        :param int seconds_from: Дата и время начала выборки данных в секундах
+        :param str tf: Интервал Алор
+        """
+        bars = subscription['bars']  # Последние бары подписки
+        if len(bars) < bars.maxlen:  # Если бары не удалялись
+            return False  # то есть все бары с начала подписки
+        return self.get_bar_open_seconds(seconds_from, tf.isdigit()) < bars[0].seconds  # Данным нужны бары раньше самого раннего хранящегося
+
+    def unsubscribe_bars(self, data) -> None:
+        """Отмена подписки данных на новые бары. Подписка на сервере Алор отменяется, когда в ней не осталось данных
+
+        :param ALData data: Данные
+        """
+        with self.bar_subscriptions_lock:  # Изменяем подписки только из одного потока
+            for key, subscription in list(self.bar_subscriptions.items()):  # Пробегаемся по всем подпискам
+                if not any(subscription_data is data for subscription_data in subscription['datas']):  # Если данных нет в подписке. Данные BackTrader сравниваем по ссылке, т.к. == у них переопределен
+                    continue  # то переходим к следующей подписке
+                subscription['datas'] = [subscription_data for subscription_data in subscription['datas'] if subscription_data is not data]  # Удаляем данные из подписки
+                if not subscription['datas']:  # Если в подписке не осталось данных
+                    self.logger.info(f'Отмена подписки {subscription["guid"]} на бары {key[0]}.{key[1]} {key[2]}')
+                    del self.bar_subscriptions[key]
+                    del self.bar_subscription_keys[subscription['guid']]
+                    self.provider.unsubscribe(subscription['guid'])  # то отменяем подписку
+
+    def open_bar_queue(self, guid) -> BarQueue:
+        """Открытие очереди новых бар подписки/расписания данных. Размер и политика переполнения очереди задаются в bar_queue_maxlen и bar_queue_policy
+
+        :param str guid: Идентификатор подписки/расписания
+        """
+        with self.new_bars_lock:
+            if guid not in self.new_bars:  # Если очередь еще не открыта
+                self.new_bars[guid] = BarQueue(self.bar_queue_maxlen, self.bar_queue_policy, self.bar_queue_block_sec)  # то открываем ее
+            return self.new_bars[guid]
+
+    def close_bar_queue(self, guid) -> None:
+        """Закрытие очереди новых бар подписки/расписания данных. Бары из очереди удаляются
+
+        :param str guid: Идентификатор подписки/расписания
+        """
+        with self.new_bars_lock:
+            bar_queue = self.new_bars.pop(guid, None)  # Удаляем очередь
+        if bar_queue:  # Если очередь была открыта
+            bar_queue.close()  # то освобождаем поток, ожидающий места в очереди
+
+    def put_new_bar(self, guid, bar):
+        """Добавление нового бара в очередь подписки/расписания"""
+        bar_queue = self.new_bars.get(guid)  # Очередь новых бар
+        if bar_queue is None:  # Если очередь не открыта или уже закрыта
+            self.metrics.inc('alor_new_bar_drops_total', 'orphan')  # то бар никто не получит
+            return  # Выходим, дальше не продолжаем
+        reason = bar_queue.put(bar)  # Ставим бар в очередь
+        if reason:  # Если при постановке бар был потерян
+            self.metrics.inc('alor_new_bar_drops_total', reason)  # то увеличиваем счетчик по причине
+        self.metrics.inc('alor_new_bars_total')
+        if perf_counter() - self.new_bars_sweep_time > self.bar_queue_orphan_sec:  # Если давно не искали очереди, которые никто не разбирает
+            self.sweep_bar_queues()  # то ищем и закрываем их
+
+    def sweep_bar_queues(self) -> None:
+        """Закрытие очередей новых бар, которые не разбирают данные хранилища дольше bar_queue_orphan_sec. Например, если данные остановились с ошибкой"""
+        self.new_bars_sweep_time = now = perf_counter()  # Время поиска
+        guids = {data.guid for data in self.datas}  # Идентификаторы подписок/расписаний запущенных данных
+        with self.new_bars_lock:
+            orphans = [guid for guid, bar_queue in self.new_bars.items() if guid not in guids and now - bar_queue.get_time > self.bar_queue_orphan_sec]  # Очереди без данных
+            bar_queues = [self.new_bars.pop(guid) for guid in orphans]  # Удаляем их
+        for guid, bar_queue in zip(orphans, bar_queues):  # Пробегаемся по всем удаленным очередям
+            self.logger.warning(f'Очередь новых бар {guid} никто не разбирает. Очередь закрыта, удалено бар: {len(bar_queue)}')
+            if len(bar_queue):  # Если в очереди были бары
+                self.metrics.inc('alor_new_bar_drops_total', 'orphan', len(bar_queue))  # то они потеряны
+            bar_queue.close()
+
+    def add_schedule(self, data) -> None:
+        """Добавление данных в планировщик получения новых бар по расписанию биржи
+
+        :param ALData data: Данные с расписанием
+        """
+        with self.schedule_condition:  # Изменяем расписание только из одного потока
+            self.schedule_guids.add(data.guid)  # Данные получают новые бары по расписанию
+            if self.schedule_thread is None:  # Если поток планировщика не запущен
+                self.schedule_thread = Thread(target=self.stream_schedule, name='ALStoreSchedule', daemon=True)  # то создаем его
+                self.schedule_thread.start()  # и запускаем
+        self.push_schedule(data)  # Ставим первый запрос в очередь
+
+    def remove_schedule(self, data) -> None:
+        """Удаление данных из планировщика. Запросы данных из очереди будут пропущены
+
+        :param ALData data: Данные с расписанием
+        """
+        with self.schedule_condition:  # Изменяем расписание только из одного потока
+            self.schedule_guids.discard(data.guid)  # Данные больше не получают новые бары по расписанию
+            self.schedule_condition.notify()  # Будим планировщик
+
+    def push_schedule(self, data) -> None:
+        """Постановка следующего запроса нового бара данных в очередь планировщика
+
+        :param ALData data: Данные с расписанием
+        """
+        request_seconds, seconds_from = data.get_schedule_request()  # Дата и время запроса и открытия бара в секундах
+        with self.schedule_condition:  # Изменяем расписание только из одного потока
+            if data.guid not in self.schedule_guids:  # Если расписание данных отменено
+                return  # то запрос не ставим
+            heappush(self.schedule, (request_seconds, data.guid, data, seconds_from))  # Ставим запрос в очередь по времени запроса
+            self.schedule_condition.notify()  # Будим планировщик. Запрос может быть раньше ожидаемого
+
+    def run_schedule(self, data, seconds_from) -> None:
+        """Запрос нового бара данных и постановка следующего запроса. Выполняется в пуле потоков планировщика
+
+        :param ALData data: Данные с расписанием
+        :param int seconds_from: Дата и время открытия бара в секундах
+        """
+        try:
+            data.get_schedule_bar(seconds_from)  # Получаем новый бар
+        except Exception as e:  # Если при получении бара произошла ошибка
+            self.logger.error(f'Ошибка получения бара по расписанию {data.guid}: {e}')  # то расписание данных не должно прерываться
+        self.push_schedule(data)  # Ставим следующий запрос в очередь
+
+    def stream_schedule(self) -> None:
+        """Поток планировщика. Запросы новых бар всех данных, время которых подошло, выполняются одной группой в пуле из schedule_workers потоков"""
+        self.logger.debug('Запуск получения новых бар по расписанию')
+        pool = ThreadPoolExecutor(max_workers=self.schedule_workers, thread_name_prefix='ALStoreScheduleRequest')  # Пул потоков запросов
+        with self.schedule_condition:
+            while self.schedule_guids:  # Пока есть данные с расписанием
+                if not self.schedule:  # Если запросов в очереди нет (все запросы выполняются)
+                    self.schedule_condition.wait()  # то ждем постановки запроса
+                    continue
+                request_seconds, guid, data, seconds_from = self.schedule[0]  # Ближайший запрос
+                if guid not in self.schedule_guids:  # Если расписание данных отменено
+                    heappop(self.schedule)  # то удаляем запрос
+                    continue
+                sleep_time_secs = request_seconds - time()  # Время ожидания в секундах
+                if sleep_time_secs > 0:  # Если время запроса еще не подошло
+                    self.schedule_condition.wait(sleep_time_secs)  # то ждем его или изменения расписания
+                    continue
+                batch = []  # Запросы, время которых подошло
+                while self.schedule and self.schedule[0][0] <= request_seconds:  # Все запросы данных с одинаковым интервалом и временем запроса
+                    _, guid, data, seconds_from = heappop(self.schedule)  # Извлекаем запрос
+                    if guid in self.schedule_guids:  # Если расписание данных не отменено
+                        batch.append((data, seconds_from))  # то выполним запрос
+                self.logger.debug(f'Запрос новых бар по расписанию: {len(batch)}')
+                for data, seconds_from in batch:  # Пробегаемся по всем запросам группы
+                    pool.submit(self.run_schedule, data, seconds_from)  # Ставим запрос в пул. Одновременно выполняется не больше schedule_workers запросов
+            self.schedule_thread = None  # Поток планировщика завершается. Следующее расписание запустит новый поток
+        pool.shutdown(wait=False, cancel_futures=True)  # Отменяем еще не начатые запросы
+        self.logger.debug('Отмена получения новых бар по расписанию')
+
+    def get_metadata(self, name, *args, offline=False):
+        """Информация о тикере или счете из кэша. Если в кэше ее нет или она устарела, то запрос к провайдеру с сохранением в кэш
+
+        :param str name: Имя метода провайдера. Например, get_symbol, get_exchange, get_account
+        :param args: Параметры метода провайдера. Должны сохраняться в JSON
+        :param bool offline: True - без подключения к Алор. Информация из кэша независимо от срока актуальности
+        :return: Результат метода провайдера
+        """
+        key = json.dumps([name, *args])  # Ключ кэша
+        item = self.metadata.get(key)  # Информация из кэша
+        if offline:  # Если работаем без подключения к Алор
+            if item is None:  # Если информации в кэше нет
+                raise LookupError(f'Информации {key} нет в кэше {self.metadata_file_name}. Запустите данные с подключением к Алор хотя бы один раз')
+            return item['value']  # Возвращаем информацию из кэша, даже если она устарела
+        if item is not None and time() - item['time'] < self.metadata_ttl_sec:  # Если информация есть в кэше и она не устарела
+            return item['value']  # то возвращаем ее без запроса
+        value = getattr(self.provider, name)(*args)  # Запрашиваем информацию у провайдера
+        if value is not None:  # Ошибки запросов не кэшируем
+            with self.metadata_lock:  # Изменяем кэш только из одного потока
+                self.metadata[key] = dict(time=time(), value=value)  # Сохраняем информацию в кэш
+                self.metadata_changed = True  # Кэш нужно будет сохранить в файл
+        return value
+
+    def invalidate_metadata(self, name=None, *args) -> None:
+        """Удаление информации из кэша. Следующее получение информации выполнит запрос к провайдеру
+
+        :param str name: Имя метода провайдера. None - очистить весь кэш
+        :param args: Параметры метода провайдера. Если не заданы, то удаляется информация по всем параметрам метода
+        """
+        with self.metadata_lock:  # Изменяем кэш только из одного потока
+            if name is None:  # Если метод не задан
+                self.metadata.clear()  # то очищаем весь кэш
+            else:  # Если задан метод
+                prefix = json.dumps([name, *args])[:-1]  # Начало ключа кэша без закрывающей скобки
+                for key in [key for key in self.metadata if key == f'{prefix}]' or key.startswith(f'{prefix},')]:  # Пробегаемся по всем ключам метода с заданными параметрами
+                    del self.metadata[key]  # Удаляем информацию из кэша
+            self.metadata_changed = True  # Кэш нужно будет сохранить в файл
+
+    def load_metadata(self) -> dict:
+        """Загрузка кэша информации о тикерах и счетах из файла"""
+        if not os.path.isfile(self.metadata_file_name):  # Если файл кэша не существует
+            return {}  # то кэш пустой
+        try:
+            with open(self.metadata_file_name, encoding='utf-8') as file:  # Открываем файл кэша на чтение
+                return json.load(file)  # Загружаем кэш
+        except (OSError, ValueError) as e:  # Если файл кэша не прочитан или поврежден
+            self.logger.warning(f'Кэш {self.metadata_file_name} не загружен: {e}')
+            return {}  # то кэш пустой. Информация будет запрошена заново
+
+    def save_metadata(self) -> None:
+        """Сохранение кэша информации о тикерах и счетах в файл, если он изменялся"""
+        with self.metadata_lock:  # Кэш не должен меняться во время сохранения
+            if not self.metadata_changed:  # Если кэш не изменялся
+                return  # то сохранять нечего
+            os.makedirs(os.path.dirname(self.metadata_file_name), exist_ok=True)  # Создаем папку для файла кэша, если ее нет
+            tmp_file_name = f'{self.metadata_file_name}.tmp'  # Временный файл. Если запись прервется, то файл кэша не будет поврежден
+            with open(tmp_file_name, 'w', encoding='utf-8') as file:  # Открываем временный файл на запись
+                json.dump(self.metadata, file, ensure_ascii=False)  # Сохраняем кэш
+            os.replace(tmp_file_name, self.metadata_file_name)  # Заменяем файл кэша
+            self.metadata_changed = False  # Кэш сохранен
+        self.logger.debug(f'Кэш сохранен в файл {self.metadata_file_name}')
 
     def get_bar_open_date_time(self, timestamp, intraday) -> datetime:
         """Дата и время открытия бара. Переводим из GMT в MSK для внутридневного интервала . Оставляем в GMT для дневок и выше."""
-        return self.provider.utc_timestamp_to_msk_datetime(timestamp) if intraday\
+        return self.utc_timestamp_to_msk_datetime(timestamp) if intraday\
             else datetime.fromtimestamp(timestamp, UTC)  # Время открытия бара
+
+    def get_bar_open_seconds(self, timestamp, intraday) -> int:
+        """Дата и время открытия бара в кол-ве секунд без учета временнОй зоны, как у get_bar_open_date_time. Дата и время бара не создаются"""
+        return timestamp + int(datetime.fromtimestamp(timestamp, self.tz_msk).utcoffset().total_seconds()) if intraday\
+            else timestamp  # Для дневок и выше время открытия бара в GMT
+
+    def get_alor_timestamp_now(self) -> float:
+        """Текущее время на сервере Алор в кол-ве секунд, прошедших с 01.01.1970 00:00 UTC
+        Запрос к серверу выполняется только при первом вызове. Дальше время считается по часам компьютера с поправкой, которая уточняется в фоне
+        """
+        if not self.time_sync_started:  # Если синхронизацию времени еще не запускали
+            with self.time_sync_lock:  # Синхронизируем время только из одного потока
+                if not self.time_sync_started:  # Если синхронизацию не запустили, пока ждали блокировку
+                    self.sync_time()  # то синхронизируем время с сервером. Если сервер не ответил, то повторим в фоне
+                    self.time_sync_exit_event = Event()  # У каждого потока синхронизации свое событие остановки. Поток прошлого запуска не продолжит работу
+                    Thread(target=self.stream_time_sync, args=(self.time_sync_exit_event,), daemon=True).start()  # Запускаем фоновую синхронизацию времени
+                    self.time_sync_started = True  # Синхронизация запущена
+        return time() + (self.time_offset or 0)  # Если сервер не ответил, то берем время компьютера
+
+    def get_alor_date_time_now(self) -> datetime:
+        """Текущие дата и время на сервере Алор по времени биржи (МСК)"""
+        return self.utc_timestamp_to_msk_datetime(self.get_alor_timestamp_now())
+
+    def msk_datetime_to_utc_timestamp(self, dt) -> int:
+        """Перевод московского времени в кол-во секунд, прошедших с 01.01.1970 00:00 UTC. Без обращения к провайдеру"""
+        return int(dt.replace(tzinfo=self.tz_msk).timestamp())
+
+    def utc_timestamp_to_msk_datetime(self, seconds) -> datetime:
+        """Перевод кол-ва секунд, прошедших с 01.01.1970 00:00 UTC, в московское время. Без обращения к провайдеру"""
+        return datetime.fromtimestamp(seconds, UTC).astimezone(self.tz_msk).replace(tzinfo=None)
+
+    def sync_time(self) -> bool:
+        """Синхронизация времени с сервером Алор. Время сервера относим к середине запроса
+
+        :return: True - время синхронизировано, False - сервер не ответил
+        """
+        time_request = time()  # Время компьютера перед запросом
+        server_timestamp = self.provider.get_time()  # Время на сервере Алор
+        time_response = time()  # Время компьютера после ответа
+        if not server_timestamp:  # Если время с сервера не получено
+            self.logger.warning('Ошибка синхронизации времени с сервером Алор')
+            return False  # то оставляем прошлую разницу времени
+        self.time_offset = server_timestamp - (time_request + time_response) / 2  # Разница между временем сервера и временем компьютера
+        self.logger.debug(f'Разница времени сервера Алор и компьютера {self.time_offset:.3f} с. Запрос {time_response - time_request:.3f} с')
+        return True
+
+    def stream_time_sync(self, exit_event) -> None:
+        """Поток синхронизации времени с сервером Алор. После ошибки синхронизация повторяется через time_sync_retry_sec секунд с удвоением интервала
+
+        :param Event exit_event: Событие остановки потока
+        """
+        retry_sec = self.time_sync_retry_sec  # Интервал повтора после ошибки
+        wait_sec = self.time_sync_sec if self.time_offset is not None else retry_sec  # Если первая синхронизация не удалась, то повторяем ее раньше
+        while not exit_event.wait(wait_sec):  # Пока не остановили хранилище, ждем
+            if self.sync_time():  # Если время синхронизировано
+                retry_sec = self.time_sync_retry_sec  # то после следующей ошибки снова начнем с короткого интервала
+                wait_sec = self.time_sync_sec  # Следующая синхронизация через time_sync_sec секунд
+            else:  # Если сервер не ответил
+                wait_sec = retry_sec  # то повторяем через интервал повтора
+                retry_sec = min(retry_sec * 2, self.time_sync_sec)  # Следующий интервал повтора удваиваем
@@ -0,0 +1,148 @@
+import logging
+import os.path
+import shutil
+import tempfile  # Временная папка для файлов истории и кэша
+from time import perf_counter
+from statistics import median, quantiles
+
+import backtrader as bt
+
+from BackTraderAlor.ALStore import ALStore  # Хранилище Alor
+from BackTraderAlor.ALData import ALData  # Данные Alor
+from FakeAlorPy import FakeAlorPy  # Подмена провайдера AlorPy без подключения к Алор
+
+
+class StopAfter(bt.Strategy):
+    """Замер времени запуска и получения бар. Останавливается после получения всех новых бар"""
+    params = (
+        ('live_bars', 0),  # Сколько новых бар получить по каждому тикеру. 0 - только история
+        ('history_end', 0),  # Дата и время последнего бара истории в формате BackTrader
+    )
+
+    def __init__(self):
+        self.started = None  # Время запуска после подготовки всех данных
+        self.bars = 0  # Кол-во полученных бар по всем тикерам
+        self.received = {data: {} for data in self.datas}  # Время получения новых бар по тикеру и дате и времени бара
+
+    def start(self):
+        self.started = perf_counter()
+
+    def next(self):
+        now = perf_counter()
+        for data in self.datas:  # Пробегаемся по всем тикерам
+            if len(data) and data.datetime[0] > self.p.history_end:  # Если пришел новый бар
+                self.received[data].setdefault(data.datetime[0], now)  # то запоминаем время его получения
+        self.bars += 1
+        if self.p.live_bars and all(len(received) >= self.p.live_bars for received in self.received.values()):  # Если получены все новые бары
+            self.env.runstop()  # то останавливаемся
+
+
+class SendOrders(bt.Strategy):
+    """Замер затрат на отправку заявок. На первом баре отправляет orders заявок"""
+    params = (
+        ('orders', 100),  # Кол-во заявок
+    )
+
+    def __init__(self):
+        self.elapsed = None  # Время отправки всех заявок в next()
+        self.sent = False
+
+    def next(self):
+        if self.sent:  # Если заявки уже отправили
+            return  # то выходим, дальше не продолжаем
+        start = perf_counter()
+        for _ in range(self.p.orders):  # Отправляем заявки
+            self.buy(data=self.data, size=10)
+        self.elapsed = perf_counter() - start
+        self.sent = True
+
+
+def percentiles(values) -> str:
+    """Медиана и 99-й процентиль в миллисекундах"""
+    if len(values) < 2:
+        return 'n/a'
+    return f'p50 {median(values) * 1000:.3f} ms, p99 {quantiles(values, n=100)[98] * 1000:.3f} ms'
+
+
+def run_history(store, feeds, bars, request_latency_sec):
+    """Получение истории: первый запуск с загрузкой из Алор и повторный запуск из файлов"""
+    for attempt in ('загрузка', 'из файла'):
+        store.provider = FakeAlorPy(history_bars=bars, request_latency_sec=request_latency_sec)
+        cerebro = bt.Cerebro(stdstats=False)
+        for i in range(feeds):
+            cerebro.adddata(store.getdata(dataname=f'TQBR.H{feeds}X{i}', timeframe=bt.TimeFrame.Minutes, compression=1))
+        cerebro.addstrategy(StopAfter)
+        start = perf_counter()
+        strategy = cerebro.run()[0]
+        elapsed = perf_counter() - start
+        print(f'История {feeds} x {bars} бар ({attempt}): запуск {strategy.started - start:.3f} с, всего {elapsed:.3f} с, {feeds * bars / elapsed:,.0f} бар/с, запросов {store.provider.requests}')
+
+
+def run_stream(store, feeds, bars, rate):
+    """Получение новых бар по подписке: пропускная способность и задержка от выдачи бара провайдером до next()"""
+    store.provider = FakeAlorPy(history_bars=100, stream_bars=bars, stream_rate=rate)
+    cerebro = bt.Cerebro(stdstats=False, quicknotify=True)
+    datas = [store.getdata(dataname=f'TQBR.L{feeds}X{i}', timeframe=bt.TimeFrame.Minutes, compression=1, live_bars=True) for i in range(feeds)]
+    for data in datas:
+        cerebro.adddata(data)
+    history_end = bt.date2num(store.provider.utc_timestamp_to_msk_datetime(store.provider.get_bar(99, 60)['time']))  # Последний бар истории
+    cerebro.addstrategy(StopAfter, live_bars=bars, history_end=history_end)
+    strategy = cerebro.run()[0]
+    latencies = []  # Задержки от выдачи бара до next()
+    first, last = float('inf'), 0
+    for data in datas:  # Пробегаемся по всем тикерам
+        sent_times = store.provider.sent_times[data.symbol]  # Время выдачи бар провайдером
+        for dt, received in strategy.received[data].items():  # Пробегаемся по всем полученным барам
+            sent = sent_times[store.provider.msk_datetime_to_utc_timestamp(bt.num2date(dt))]
+            latencies.append(received - sent)
+            first, last = min(first, sent), max(last, received)
+    print(f'Новые бары {feeds} x {bars} бар, {rate or "без ограничения"} бар/с: {len(latencies) / (last - first):,.0f} бар/с, задержка {percentiles(latencies)}')
+
+
+def run_startup(store, feeds, request_latency_sec):
+    """Время запуска N тикеров при задержке ответов Алор"""
+    shutil.rmtree(ALData.datapath, ignore_errors=True)  # Запуск без файлов истории
+    os.makedirs(ALData.datapath)
+    store.provider = FakeAlorPy(history_bars=1000, request_latency_sec=request_latency_sec)
+    cerebro = bt.Cerebro(stdstats=False)
+    for i in range(feeds):
+        cerebro.adddata(store.getdata(dataname=f'TQBR.S{i}', timeframe=bt.TimeFrame.Minutes, compression=1))
+    cerebro.addstrategy(StopAfter)
+    start = perf_counter()
+    strategy = cerebro.run()[0]
+    print(f'Запуск {feeds} тикеров, задержка ответа {request_latency_sec * 1000:.0f} мс: {strategy.started - start:.3f} с')
+
+
+def run_orders(store, orders, order_latency_sec, async_orders):
+    """Затраты на отправку заявок в next() и время от отправки до ответа и от ответа до сделки"""
+    store.provider = FakeAlorPy(history_bars=10, order_latency_sec=order_latency_sec, fill_delay_sec=0.01)
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.setbroker(store.getbroker(async_orders=async_orders))
+    cerebro.adddata(store.getdata(dataname='TQBR.SBER', timeframe=bt.TimeFrame.Minutes, compression=1))
+    cerebro.addstrategy(SendOrders, orders=orders)
+    before = store.metrics.snapshot()  # Метрики копятся с запуска хранилища. Берем разницу
+    strategy = cerebro.run()[0]
+    after = store.metrics.snapshot()
+    ack, fill = ({key: after[name][key] - before.get(name, dict(sum=0, count=0))[key] for key in ('sum', 'count')} for name in ('alor_order_ack_seconds', 'alor_order_fill_seconds'))
+    print(f'Заявки {orders} шт., задержка ответа {order_latency_sec * 1000:.0f} мс, {"асинхронно" if async_orders else "синхронно"}: '
+          f'в next() {strategy.elapsed / orders * 1000:.3f} мс/заявка, ответ {ack["sum"] / max(ack["count"], 1) * 1000:.3f} мс, сделка {fill["sum"] / max(fill["count"], 1) * 1000:.3f} мс')
+
+
+if __name__ == '__main__':  # Точка входа при запуске этого скрипта
+    logging.basicConfig(level=logging.ERROR)  # Выводим только ошибки, чтобы лог не влиял на замеры
+    temp_path = tempfile.mkdtemp(prefix='BackTraderAlorBenchmark')  # Файлы истории и кэш не должны смешиваться с рабочими
+    ALData.datapath = os.path.join(temp_path, 'Alor', '')
+    os.makedirs(ALData.datapath)  # Папка файлов истории должна существовать
+    ALStore.metadata_file_name = os.path.join(temp_path, 'metadata.json')
+    store = ALStore(provider=FakeAlorPy())  # Хранилище с подменой провайдера
+    try:
+        run_history(store, feeds=1, bars=100_000, request_latency_sec=0)
+        run_history(store, feeds=10, bars=10_000, request_latency_sec=0.01)
+        run_startup(store, feeds=50, request_latency_sec=0.05)
+        run_stream(store, feeds=1, bars=1000, rate=0)
+        run_stream(store, feeds=10, bars=100, rate=200)
+        run_orders(store, orders=100, order_latency_sec=0, async_orders=False)
+        run_orders(store, orders=20, order_latency_sec=0.05, async_orders=False)
+        run_orders(store, orders=20, order_latency_sec=0.05, async_orders=True)
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
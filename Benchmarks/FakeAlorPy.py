@@ -0,0 +1,218 @@
+from datetime import datetime, UTC
+from zoneinfo import ZoneInfo  # ВременнАя зона МСК
+from time import sleep, perf_counter
+from threading import Thread, Timer, Lock  # Поток выдачи новых бар, отложенные сделки и отмены заявок, блокировка номеров
+from bisect import bisect_left, bisect_right  # Поиск бар по дате и времени в записанном потоке
+import csv
+
+
+class FakeAlorPy:
+    """Подмена провайдера AlorPy для замеров производительности без подключения к Алор
+    Реализует методы AlorPy, которые вызывают хранилище, данные и брокер. Бары синтетические или из файла истории ALData
+    """
+    tz_msk = ZoneInfo('Europe/Moscow')  # ВременнАя зона МСК
+
+    def __init__(self, history_start=datetime(2024, 1, 1, tzinfo=UTC), history_bars=10_000, recorded_bars=None,
+                 stream_bars=0, stream_rate=0, request_latency_sec=0, order_latency_sec=0, fill_delay_sec=None, cash=1_000_000):
+        """Инициализация
+
+        :param datetime history_start: Дата и время UTC первого синтетического бара
+        :param int history_bars: Кол-во синтетических бар в истории. Новые бары продолжают историю
+        :param list recorded_bars: Записанные бары вместо синтетических (словари time, open, high, low, close, volume). См. load_recorded_bars
+        :param int stream_bars: Кол-во новых бар, выдаваемых по каждой подписке
+        :param float stream_rate: Новых бар в секунду. 0 - без задержек
+        :param float request_latency_sec: Задержка ответа на запрос истории в секундах
+        :param float order_latency_sec: Задержка ответа на постановку заявки в секундах
+        :param float fill_delay_sec: Через сколько секунд после постановки заявка исполняется. None - заявки не исполняются
+        :param float cash: Свободные средства
+        """
+        self.history_start = int(history_start.timestamp())  # Дата и время первого синтетического бара в секундах
+        self.history_bars = history_bars
+        self.recorded_bars = recorded_bars
+        self.recorded_times = [bar['time'] for bar in recorded_bars] if recorded_bars else None  # Даты и время записанных бар для поиска
+        self.stream_bars = stream_bars
+        self.stream_rate = stream_rate
+        self.request_latency_sec = request_latency_sec
+        self.order_latency_sec = order_latency_sec
+        self.fill_delay_sec = fill_delay_sec
+        self.cash = cash
+        self.accounts = [dict(account_id=0, portfolio='D00000', boards=['TQBR', 'RFUD'], exchanges=['MOEX'])]  # Счета
+        self.subscriptions = {}  # Подписки по идентификатору
+        self.sent_times = {}  # Время выдачи новых бар по тикеру и дате и времени бара для замера задержек
+        self.lock = Lock()  # Блокировка номеров подписок и заявок
+        self.number = 0  # Последний номер подписки/заявки
+        self.requests = 0  # Кол-во запросов к провайдеру
+        for handler in ('on_entering', 'on_enter', 'on_connect', 'on_resubscribe', 'on_ready', 'on_disconnect', 'on_timeout', 'on_error', 'on_cancel', 'on_exit',
+                        'on_new_bar', 'on_position', 'on_trade', 'on_order', 'on_stop_order_v2'):
+            setattr(self, handler, self.default_handler)  # Обработчики событий по умолчанию
+
+    @staticmethod
+    def load_recorded_bars(file_name, delimiter='\t', dt_format='%d.%m.%Y %H:%M') -> list:
+        """Бары из текстового файла истории ALData для выдачи вместо синтетических"""
+        tz_msk = FakeAlorPy.tz_msk
+        with open(file_name, newline='') as file:
+            reader = csv.reader(file, delimiter=delimiter)
+            next(reader)  # Пропускаем заголовок
+            return [dict(time=int(datetime.strptime(row[0], dt_format).replace(tzinfo=tz_msk).timestamp()),
+                         open=float(row[1]), high=float(row[2]), low=float(row[3]), close=float(row[4]), volume=int(float(row[5]))) for row in reader]
+
+    def next_number(self) -> int:
+        """Следующий номер подписки/заявки"""
+        with self.lock:
+            self.number += 1
+            return self.number
+
+    def default_handler(self, *args, **kwargs):
+        pass
+
+    def close_web_socket(self):
+        for guid in list(self.subscriptions):  # Останавливаем выдачу новых бар по всем подпискам
+            self.unsubscribe(guid)
+
+    # Информация о тикерах и счетах
+
+    def dataname_to_alor_board_symbol(self, dataname):
+        board, symbol = dataname.split('.', 1)
+        return board, symbol
+
+    def get_exchange(self, board, symbol):
+        self.requests += 1
+        return 'MOEX'
+
+    def get_symbol(self, exchange, symbol):
+        self.requests += 1
+        return dict(lotsize=10, board='TQBR', primary_board='TQBR', minstep=0.01)
+
+    get_symbol_info = get_symbol
+
+    def get_account(self, board, account_id=0):
+        return next((account for account in self.accounts if account['account_id'] == account_id and board in account['boards']), None)
+
+    def get_time(self):
+        self.requests += 1
+        return int(datetime.now(UTC).timestamp())
+
+    # Перевод цен и кол-ва. Цены Алор в рублях за штуку, лот 10 штук
+
+    def alor_price_to_price(self, exchange, symbol, alor_price):
+        return alor_price
+
+    def price_to_alor_price(self, exchange, symbol, price):
+        return round(price, 2)
+
+    def price_to_valid_price(self, exchange, symbol, price):
+        return round(price, 2)
+
+    def lots_to_size(self, exchange, symbol, lots):
+        return lots * 10
+
+    def size_to_lots(self, exchange, symbol, size):
+        return int(size / 10)
+
+    # Дата и время
+
+    def msk_datetime_to_utc_timestamp(self, dt) -> int:
+        return int(dt.replace(tzinfo=self.tz_msk).timestamp())
+
+    def utc_timestamp_to_msk_datetime(self, seconds) -> datetime:
+        return datetime.fromtimestamp(seconds, self.tz_msk).replace(tzinfo=None)
+
+    def utc_to_msk_datetime(self, dt) -> datetime:
+        return dt.replace(tzinfo=UTC).astimezone(self.tz_msk).replace(tzinfo=None)
+
+    # Бары
+
+    def get_bar(self, i, step) -> dict:
+        """Синтетический бар по номеру"""
+        price = 100 + (i * 7919 % 2000) / 100  # Цена повторяется каждые 2000 бар
+        return dict(time=self.history_start + i * step, open=price, high=price + 1, low=price - 1, close=price + 0.5, volume=i % 1000 + 1)
+
+    def get_history(self, exchange, symbol, tf, seconds_from=0, seconds_to=32536799999, untraded=False, format='Simple'):
+        self.requests += 1
+        if self.request_latency_sec:  # Если задана задержка ответа
+            sleep(self.request_latency_sec)
+        if self.recorded_bars:  # Если выдаем записанные бары
+            return dict(history=self.recorded_bars[bisect_left(self.recorded_times, seconds_from):bisect_right(self.recorded_times, seconds_to)])
+        step = int(tf) if tf.isdigit() else 86400  # Интервал в секундах
+        i_from = max(0, -(-(seconds_from - self.history_start) // step))  # Номер первого бара не раньше начала выборки
+        i_to = min(self.history_bars - 1, (seconds_to - self.history_start) // step)  # Номер последнего бара не позже окончания выборки
+        return dict(history=[self.get_bar(i, step) for i in range(i_from, i_to + 1)])
+
+    def bars_get_and_subscribe(self, exchange, symbol, tf='60', seconds_from=0, frequency=0):
+        guid = f'fake-{self.next_number()}'  # Идентификатор подписки
+        self.subscriptions[guid] = dict(opcode='BarsGetAndSubscribe', exchange=exchange, code=symbol, tf=tf, format='Simple', frequency=frequency)
+        if self.stream_bars:  # Если нужно выдавать новые бары
+            Thread(target=self.stream, args=(guid,), name=f'FakeAlorPyStream.{guid}', daemon=True).start()
+        return guid
+
+    def unsubscribe(self, guid):
+        self.subscriptions.pop(guid, None)
+
+    def stream(self, guid) -> None:
+        """Поток выдачи новых бар по подписке. Новые бары продолжают историю"""
+        tf = self.subscriptions[guid]['tf']
+        step = int(tf) if tf.isdigit() else 86400  # Интервал в секундах
+        if self.recorded_bars:  # Если выдаем записанные бары
+            bars = self.recorded_bars[-self.stream_bars:]  # то новыми барами будут последние записанные бары
+        else:  # Если выдаем синтетические бары
+            bars = [self.get_bar(self.history_bars + i, step) for i in range(self.stream_bars)]  # то продолжаем историю
+        sent_times = self.sent_times.setdefault(self.subscriptions[guid]['code'], {})  # Время выдачи новых бар по дате и времени бара
+        interval = 1 / self.stream_rate if self.stream_rate else 0  # Интервал между барами в секундах
+        start = perf_counter()
+        for i, bar in enumerate(bars):  # Пробегаемся по всем новым барам
+            if guid not in self.subscriptions:  # Если подписку отменили
+                return  # то выходим, дальше не продолжаем
+            delay = start + i * interval - perf_counter()  # Время до выдачи бара
+            if delay > 0:
+                sleep(delay)
+            sent_times[bar['time']] = perf_counter()  # Время выдачи бара
+            self.on_new_bar(dict(guid=guid, data=bar))  # Выдаем бар как WebSocket
+
+    # Счета и заявки
+
+    def get_positions(self, portfolio, exchange, without_currency=False):
+        return [dict(portfolio=portfolio, exchange=exchange, symbol='RUB', isCurrency=True, volume=self.cash, qty=self.cash, avgPrice=1)]
+
+    def positions_get_and_subscribe_v2(self, portfolio, exchange):
+        return self.subscribe(portfolio, exchange, 'PositionsGetAndSubscribeV2')
+
+    def trades_get_and_subscribe_v2(self, portfolio, exchange):
+        return self.subscribe(portfolio, exchange, 'TradesGetAndSubscribeV2')
+
+    def orders_get_and_subscribe_v2(self, portfolio, exchange):
+        return self.subscribe(portfolio, exchange, 'OrdersGetAndSubscribeV2')
+
+    def stop_orders_get_and_subscribe_v2(self, portfolio, exchange):
+        return self.subscribe(portfolio, exchange, 'StopOrdersGetAndSubscribeV2')
+
+    def subscribe(self, portfolio, exchange, opcode):
+        guid = f'fake-{self.next_number()}'
+        self.subscriptions[guid] = dict(opcode=opcode, portfolio=portfolio, exchange=exchange)
+        return guid
+
+    def create_order(self, portfolio, exchange, symbol, side, quantity, price):
+        """Постановка заявки с задержкой ответа. Если задана задержка исполнения, то по заявке придет сделка"""
+        if self.order_latency_sec:  # Если задана задержка ответа
+            sleep(self.order_latency_sec)
+        order_number = str(self.next_number())  # Номер заявки на бирже
+        if self.fill_delay_sec is not None:  # Если заявка должна исполниться
+            trade = dict(existing=False, orderno=order_number, qtyUnits=self.lots_to_size(exchange, symbol, quantity), side=side, price=price,
+                         date=datetime.now(UTC).strftime('%Y-%m-%dT%H:%M:%S.0000000Z'), portfolio=portfolio, exchange=exchange, symbol=symbol)
+            Timer(self.fill_delay_sec, lambda: self.on_trade(dict(data=trade))).start()
+        return dict(orderNumber=order_number)
+
+    def create_market_order(self, portfolio, exchange, symbol, side, quantity):
+        return self.create_order(portfolio, exchange, symbol, side, quantity, 100)
+
+    def create_limit_order(self, portfolio, exchange, symbol, side, quantity, limit_price):
+        return self.create_order(portfolio, exchange, symbol, side, quantity, limit_price)
+
+    def create_stop_order(self, portfolio, exchange, symbol, class_code, side, quantity, stop_price, condition='Less'):
+        return self.create_order(portfolio, exchange, symbol, side, quantity, stop_price)
+
+    def create_stop_limit_order(self, portfolio, exchange, symbol, class_code, side, quantity, stop_price, limit_price, condition='Less'):
+        return self.create_order(portfolio, exchange, symbol, side, quantity, limit_price)
+
+    def delete_order(self, portfolio, exchange, order_id, stop=False):
+        data = dict(id=order_id, status='canceled', portfolio=portfolio, exchange=exchange)
+        Timer(self.order_latency_sec, lambda: (self.on_stop_order_v2 if stop else self.on_order)(dict(data=data))).start()  # Отмена придет по подписке
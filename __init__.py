@@ -1,3 +1,5 @@
+from .ALMetrics import *  # Метрики задержек и пропускной способности
+from .ALBar import *  # Бар и колонки бар
 from .ALStore import *
 from .ALData import *  # Также подключает данные в хранилище
 from .ALBroker import *  # Также подключает брокера в хранилище